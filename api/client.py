@@ -0,0 +1,134 @@
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from api.ratelimit import RateLimiter
+from monitoring.metrics import REGISTRY, BYTES_BUCKETS
+
+DEFAULT_TIMEOUT = (5, 60) # (connect, read) w sekundach
+DEFAULT_POOL_SIZE = 16
+DEFAULT_MAX_RETRIES = 5 # ponowienia po odpowiedzi 429
+
+class KsefClient:
+    """Shared HTTP client for KSeF API with a pooled keep-alive session."""
+
+    def __init__(self, base_url: str, timeout=DEFAULT_TIMEOUT, pool_size: int = DEFAULT_POOL_SIZE, headers: dict | None = None,
+                 limiter: RateLimiter | None = None, max_retries: int = DEFAULT_MAX_RETRIES):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+        self.limiter = limiter or RateLimiter()
+        self.max_retries = max_retries
+
+        self.session = requests.Session()
+        self.session.headers.update({
+            "Accept": "application/json",
+        })
+        if headers:
+            self.session.headers.update(headers)
+
+        # one adapter for both schemes, keeps connections alive between calls
+        self.adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("https://", self.adapter)
+        self.session.mount("http://", self.adapter)
+
+        self.lock = threading.Lock()
+        self.request_count = 0
+
+    def url(self, path: str) -> str:
+        if path.startswith("http://") or path.startswith("https://"):
+            return path
+        return self.base_url + "/" + path.lstrip("/")
+
+    def request(self, method: str, path: str, auth_token=None, headers: dict | None = None, rate_key=None, **kwargs):
+        """Send request to KSeF. `auth_token` adds Bearer authorization header.
+
+        Requests wait for the rate limiter of their endpoint and `rate_key` (defaults to the token,
+        which identifies the NIP context). Throttled (429) requests are re-sent after Retry-After.
+        """
+        req_headers = {}
+        if auth_token:
+            req_headers["Authorization"] = "Bearer " + str(auth_token)
+        if headers:
+            req_headers.update(headers)
+        kwargs.setdefault("timeout", self.timeout)
+        if rate_key is None:
+            rate_key = auth_token
+
+        endpoint = self.endpoint_label(path)
+        for attempt in range(self.max_retries + 1):
+            wait_start = time.perf_counter()
+            self.limiter.acquire(path, rate_key)
+            start = time.perf_counter()
+            REGISTRY.observe("ksef_rate_limit_wait_seconds", start - wait_start, endpoint=endpoint)
+            with self.lock:
+                self.request_count += 1
+            try:
+                response = self.session.request(method, self.url(path), headers=req_headers, **kwargs)
+            except requests.RequestException:
+                REGISTRY.observe("ksef_http_request_duration_seconds", time.perf_counter() - start,
+                                 method=method, endpoint=endpoint, status="error")
+                raise
+            self._record(method, endpoint, response, time.perf_counter() - start, kwargs.get("stream", False))
+            if response.status_code != 429 or attempt == self.max_retries:
+                return response
+            wait = self.limiter.throttle(path, rate_key, response)
+            print(f"KSeF 429 dla {self.limiter.endpoint(path)}, ponowienie za {wait:.1f}s")
+            response.close() # limiter holds the next attempt until Retry-After passes
+        return response
+
+    def endpoint_label(self, path: str) -> str:
+        """Endpoint group used in metrics; absolute URLs (export package parts) are one group."""
+        return self.limiter.endpoint(path)
+
+    def _record(self, method, endpoint, response, seconds, stream):
+        # time to response headers; streamed bodies are counted by Content-Length
+        if stream:
+            size = int(response.headers.get("Content-Length") or 0)
+        else:
+            size = len(response.content)
+        status = str(response.status_code)
+        REGISTRY.observe("ksef_http_request_duration_seconds", seconds, method=method, endpoint=endpoint, status=status)
+        REGISTRY.observe("ksef_http_response_bytes", size, buckets=BYTES_BUCKETS, endpoint=endpoint)
+        REGISTRY.inc("ksef_http_response_bytes_total", size, endpoint=endpoint)
+
+    def get(self, path: str, auth_token=None, **kwargs):
+        return self.request("GET", path, auth_token=auth_token, **kwargs)
+
+    def post(self, path: str, auth_token=None, **kwargs):
+        return self.request("POST", path, auth_token=auth_token, **kwargs)
+
+    def stats(self) -> dict:
+        """Return connection reuse stats: requests sent vs. new TCP/TLS connections opened."""
+        connections = 0
+        pools = self.adapter.poolmanager.pools
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is not None:
+                connections += pool.num_connections
+        with self.lock:
+            requests_sent = self.request_count
+        return {
+            "requests": requests_sent,
+            "connections": connections,
+            "reused": max(requests_sent - connections, 0),
+            "rate_limit": self.limiter.stats(),
+        }
+
+    def close(self):
+        self.session.close()
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+def get_client(BASE) -> KsefClient:
+    """Return shared client for given base url (or the client itself if one is passed)."""
+    if isinstance(BASE, KsefClient):
+        return BASE
+    key = str(BASE).rstrip("/")
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is None:
+            client = KsefClient(key)
+            _clients[key] = client
+        return client
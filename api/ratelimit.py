@@ -0,0 +1,171 @@
+import re
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+
+# Domyślne limity (żądań na sekundę, maksymalna seria) dla grup endpointów, osobno dla każdego
+# kontekstu (NIP). Po odpowiedzi 429 limit danej grupy jest zmniejszany do wartości podanej przez KSeF.
+DEFAULT_LIMITS = {
+    "/invoices/query/metadata": (8, 8),
+    "/invoices/ksef": (8, 8),
+    "/invoices/exports": (4, 4),
+    "/auth": (10, 10),
+}
+DEFAULT_LIMIT = (10, 10)
+EXTERNAL = "external"   # grupa bezwzględnych adresów (części paczek eksportu)
+GLOBAL_KEY = "*"        # klucz kubełka wspólnego dla wszystkich kontekstów (tylko z global_limits)
+DEFAULT_RETRY_AFTER = 5 # s, gdy 429 nie podaje czasu
+
+_UNITS = {
+    "sekund": 1, "second": 1,
+    "minut": 60, "minute": 60,
+    "godzin": 3600, "hour": 3600,
+}
+
+
+class TokenBucket:
+    """Thread-safe token bucket; `block` pauses it until a 429 Retry-After has passed."""
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.monotonic()
+        self.blocked_until = 0.0
+        self.lock = threading.Lock()
+        self.waited = 0.0
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self._refill(now)
+                if now < self.blocked_until:
+                    wait = self.blocked_until - now
+                elif self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                else:
+                    wait = (1 - self.tokens) / self.rate
+                self.waited += wait
+            time.sleep(wait)
+
+    def block(self, seconds: float):
+        with self.lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+            self.tokens = 0
+
+    def set_rate(self, rate: float, burst: float):
+        with self.lock:
+            self._refill(time.monotonic())
+            self.rate = rate
+            self.burst = burst
+            self.tokens = min(self.tokens, burst)
+
+
+class RateLimiter:
+    """Token buckets per (endpoint group, key), where key identifies the NIP context.
+
+    `limits` apply to every context separately; requests without a key share one bucket.
+    `global_limits` optionally cap an endpoint group across all contexts together.
+    """
+
+    def __init__(self, limits: dict | None = None, default=DEFAULT_LIMIT, global_limits: dict | None = None):
+        self.limits = dict(DEFAULT_LIMITS if limits is None else limits)
+        self.default = default
+        self.global_limits = dict(global_limits or {})
+        self.buckets = {}
+        self.lock = threading.Lock()
+        self.throttled = 0
+
+    def endpoint(self, path: str) -> str:
+        """Map request path (with ids) to the longest configured endpoint group.
+
+        Absolute URLs (pre-signed export package parts) are one EXTERNAL group, not a bucket each.
+        """
+        if path.startswith("http://") or path.startswith("https://"):
+            return EXTERNAL
+        path = "/" + path.split("?", 1)[0].strip("/")
+        best = None
+        for prefix in self.limits:
+            if (path == prefix or path.startswith(prefix + "/")) and (best is None or len(prefix) > len(best)):
+                best = prefix
+        return best or path
+
+    def _bucket(self, endpoint, key):
+        with self.lock:
+            bucket = self.buckets.get((endpoint, key))
+            if bucket is None:
+                limits = self.global_limits if key == GLOBAL_KEY else self.limits
+                rate, burst = limits.get(endpoint, self.default)
+                bucket = TokenBucket(rate, burst)
+                self.buckets[(endpoint, key)] = bucket
+            return bucket
+
+    def acquire(self, path: str, key=None):
+        endpoint = self.endpoint(path)
+        if endpoint in self.global_limits:
+            self._bucket(endpoint, GLOBAL_KEY).acquire()
+        self._bucket(endpoint, key).acquire()
+
+    def throttle(self, path: str, key, response) -> float:
+        """Handle 429 response: pause the bucket and adopt the limit reported by KSeF. Returns wait in seconds."""
+        endpoint = self.endpoint(path)
+        bucket = self._bucket(endpoint, key)
+        wait, limit = parse_retry(response)
+        if limit:
+            bucket.set_rate(*limit)
+        bucket.block(wait)
+        with self.lock:
+            self.throttled += 1
+        return wait
+
+    def stats(self) -> dict:
+        with self.lock:
+            buckets = list(self.buckets.items())
+            throttled = self.throttled
+        waited = {}
+        for (endpoint, key), bucket in buckets:
+            waited[endpoint] = round(waited.get(endpoint, 0) + bucket.waited, 3)
+        return {"throttled": throttled, "waited": waited}
+
+
+def parse_retry(response):
+    """Return (retry_after_seconds, (rate, burst) or None) from a 429 response."""
+    wait = None
+    header = response.headers.get("Retry-After")
+    if header:
+        try:
+            wait = float(header)
+        except ValueError:
+            try:
+                wait = (parsedate_to_datetime(header) - datetime.now(timezone.utc)).total_seconds()
+            except (TypeError, ValueError):
+                wait = None
+
+    details = []
+    try:
+        status = response.json().get("status") or {}
+        details = [str(d) for d in status.get("details") or []]
+    except ValueError:
+        pass
+
+    limit = None
+    for detail in details:
+        text = detail.lower()
+        if wait is None:
+            m = re.search(r"(\d+)\s*(sekund|second|s\b)", text)
+            if m: wait = float(m.group(1))
+        m = re.search(r"(\d+)\s*(?:żądań|zapytań|requests?)\D{0,20}?(sekund|second|minut|minute|godzin|hour)", text)
+        if m and not limit:
+            count = int(m.group(1))
+            limit = (count / _UNITS[m.group(2)], max(count, 1))
+
+    if wait is None or wait < 0:
+        wait = DEFAULT_RETRY_AFTER
+    return wait, limit
@@ -1,4 +1,4 @@
-import requests
+from api.client import get_client
 
 DEBUG = False
 
@@ -7,14 +7,14 @@ DEBUG = False
 def auth_check(BASE, reference, auth_token):
     headers = {
         "Content-Type": "application/json",
-        "Authorization": "Bearer "+str(auth_token),
     }
     body = {
         "subjectType": "Subject1",
     }
 
-    auth = requests.get(
-        BASE+"/auth/"+str(reference),
+    auth = get_client(BASE).get(
+        "/auth/"+str(reference),
+        auth_token=auth_token,
         headers=headers,
         data=body
     )
@@ -27,9 +27,8 @@ def auth_check(BASE, reference, auth_token):
 def get_access_token(BASE, auth_token):
     headers = {
         "Content-Type": "application/json",
-        "Authorization": "Bearer "+str(auth_token),
     }
-    tokens = requests.post(f"{BASE}/auth/token/redeem", headers=headers)
+    tokens = get_client(BASE).post("/auth/token/redeem", auth_token=auth_token, headers=headers)
     if(DEBUG): print("\nAccessToken:")
     if(DEBUG): print("Status code:",tokens.status_code)
 
@@ -44,13 +43,12 @@ def get_access_token(BASE, auth_token):
     print("validUntil:", validUntil)
     return accessToken, refreshToken, validUntil
 
-# pass
-def refresh_access_token(BASE, refresh_token):
+def refresh_access_token(BASE, refresh_token, rate_key=None):
+    """Get new access token using refresh token. Returned refreshToken is None if KSeF did not rotate it."""
     headers = {
         "Content-Type": "application/json",
-        "Authorization": f"Bearer {refresh_token}"
     }
-    tokens = requests.post(f"{BASE}/auth/token/refresh", headers=headers)
+    tokens = get_client(BASE).post("/auth/token/refresh", auth_token=refresh_token, headers=headers, rate_key=rate_key)
     if(DEBUG): print("\nRefreshed AccessToken:")
     if(DEBUG): print("Status code:",tokens.status_code)
 
@@ -59,7 +57,7 @@ def refresh_access_token(BASE, refresh_token):
         return None, None, None
     
     accessToken = tokens.json().get("accessToken").get("token")
-    refreshToken = tokens.json().get("refreshToken").get("token")
+    refreshToken = (tokens.json().get("refreshToken") or {}).get("token")
     validUntil = tokens.json().get("accessToken").get("validUntil")
 
     print("validUntil:", validUntil)
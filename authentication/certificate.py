@@ -0,0 +1,131 @@
+import base64
+import json
+import os
+import re
+import threading
+from datetime import datetime, timedelta, timezone
+from Cryptodome.Hash import SHA256
+from Cryptodome.PublicKey import RSA
+from Cryptodome.Cipher import PKCS1_OAEP
+from api.client import get_client
+
+CERT_CACHE_FILE = os.path.join("data", "certificates.json")
+DEFAULT_TTL = timedelta(hours=24) # gdy certyfikat nie podaje daty ważności
+
+TOKEN_ENCRYPTION = "KsefTokenEncryption"
+SYMMETRIC_KEY_ENCRYPTION = "SymmetricKeyEncryption"
+
+
+class CertificateCipher:
+    """RSA-OAEP (SHA-256) cipher built from a KSeF public key certificate, reusable until valid_to."""
+
+    def __init__(self, pem: str, valid_from: datetime | None, valid_to: datetime):
+        # Jeśli certyfikat jest zakodowany w Base64 bez nagłówków PEM, dodaj nagłówki:
+        if "BEGIN CERTIFICATE" not in pem:
+            pem = "-----BEGIN CERTIFICATE-----\n" + pem + "\n-----END CERTIFICATE-----"
+
+        # Wyodrębnij klucz publiczny
+        pem_body = re.sub(r"-----.*?-----", "", pem, flags=re.S)
+        der_bytes = base64.b64decode(pem_body)
+
+        self.key = RSA.import_key(der_bytes)
+        self.cipher = PKCS1_OAEP.new(self.key, hashAlgo=SHA256)
+        self.valid_from = valid_from
+        self.valid_to = valid_to
+        self.lock = threading.Lock()
+
+    def is_valid(self, now: datetime | None = None) -> bool:
+        now = now or datetime.now(timezone.utc)
+        if self.valid_from and now < self.valid_from:
+            return False
+        return now < self.valid_to
+
+    def encrypt(self, data: bytes) -> bytes:
+        with self.lock:
+            return self.cipher.encrypt(data)
+
+
+_ciphers = {}
+_ciphers_lock = threading.Lock()
+
+def _parse_date(value):
+    if not value:
+        return None
+    ts = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    if ts.tzinfo is None:
+        ts = ts.replace(tzinfo=timezone.utc)
+    return ts
+
+def _select_certificate(certs, usage, fetched_at):
+    """Return CertificateCipher for currently valid certificate with given usage, or None."""
+    now = datetime.now(timezone.utc)
+    for cert in certs:
+        if usage not in cert.get("usage", []):
+            continue
+        valid_to = _parse_date(cert.get("validTo")) or (_parse_date(fetched_at) or now) + DEFAULT_TTL
+        cipher = CertificateCipher(cert.get("certificate"), _parse_date(cert.get("validFrom")), valid_to)
+        if cipher.is_valid(now):
+            return cipher
+    return None
+
+def _read_cache_file(cache_file):
+    if not cache_file or not os.path.exists(cache_file):
+        return {}
+    try:
+        with open(cache_file, "r") as f:
+            return json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return {}
+
+def _write_cache_file(cache_file, BASE, entry):
+    if not cache_file:
+        return
+    data = _read_cache_file(cache_file)
+    if entry is None:
+        data.pop(BASE, None)
+    else:
+        data[BASE] = entry
+    folder = os.path.dirname(cache_file)
+    if folder:
+        os.makedirs(folder, exist_ok=True)
+    with open(cache_file, "w") as f:
+        json.dump(data, f)
+
+def get_cipher(BASE, usage=TOKEN_ENCRYPTION, cache_file=CERT_CACHE_FILE) -> CertificateCipher:
+    """Return cached cipher for KSeF public key with given usage.
+
+    Looks in memory, then in `cache_file`, and downloads /security/public-key-certificates
+    only when no valid certificate is cached.
+    """
+    key = (str(BASE), usage)
+    with _ciphers_lock:
+        cipher = _ciphers.get(key)
+        if cipher and cipher.is_valid():
+            return cipher
+
+        entry = _read_cache_file(cache_file).get(str(BASE))
+        if entry:
+            cipher = _select_certificate(entry.get("certificates", []), usage, entry.get("fetched"))
+
+        if not cipher or not cipher.is_valid():
+            certs_resp = get_client(BASE).get("/security/public-key-certificates")
+            certs_resp.raise_for_status()
+            entry = {
+                "fetched": datetime.now(timezone.utc).isoformat(),
+                "certificates": certs_resp.json(),
+            }
+            _write_cache_file(cache_file, str(BASE), entry)
+            cipher = _select_certificate(entry["certificates"], usage, entry["fetched"])
+
+        if not cipher:
+            raise Exception(f"Nie znaleziono certyfikatu typu {usage}")
+        _ciphers[key] = cipher
+        return cipher
+
+def invalidate(BASE, cache_file=CERT_CACHE_FILE):
+    """Drop cached certificates for BASE, e.g. after KSeF rotated its keys."""
+    with _ciphers_lock:
+        for key in [k for k in _ciphers if k[0] == str(BASE)]:
+            del _ciphers[key]
+        if str(BASE) in _read_cache_file(cache_file):
+            _write_cache_file(cache_file, str(BASE), None)
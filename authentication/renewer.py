@@ -0,0 +1,108 @@
+import json
+import threading
+from datetime import datetime, timedelta, timezone
+from authentication.token import ensure_session, load_sessions, update_sessions, parse_timestamp
+
+RENEW_MARGIN = timedelta(minutes=5) # odnawiaj token tyle przed wygaśnięciem
+CHECK_INTERVAL = 60                 # maksymalny odstęp między sprawdzeniami (s)
+RETRY_INTERVAL = 30                 # ponowna próba po błędzie odnowienia (s), potem x2
+MAX_RETRY_INTERVAL = 30 * 60        # maksymalny odstęp ponownych prób dla firmy z błędem (s)
+
+
+class TokenRenewer:
+    """Background thread keeping access tokens in `session_file` valid.
+
+    Every company from `secret_file` is renewed `margin` before its `validUntil`,
+    so start_session / start_multi_session find a warm token and return without network calls.
+    With `quiet` (default) only refreshes, re-authentications and failures are logged,
+    not every check of a still valid token.
+    """
+
+    def __init__(self, BASE, secret_file, session_file, margin=RENEW_MARGIN, interval=CHECK_INTERVAL, quiet=True):
+        self.BASE = BASE
+        self.secret_file = secret_file
+        self.session_file = session_file
+        self.margin = margin
+        self.interval = interval
+        self.quiet = quiet
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.failed = {} # company -> last error
+        self.failures = {} # company -> consecutive failed renewals
+        self.retry_at = {} # company -> time of the next attempt after a failure
+
+    def start(self):
+        if self.thread and self.thread.is_alive():
+            return self
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self._run, name="ksef-token-renewer", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread:
+            self.thread.join()
+
+    def _run(self):
+        while not self.stop_event.is_set():
+            try:
+                wait = self.renew_due()
+            except Exception as e:
+                print(f"Błąd odnawiania tokenów: {e}")
+                wait = RETRY_INTERVAL
+            self.stop_event.wait(wait)
+
+    def renew_due(self):
+        """Renew tokens expiring within margin. Returns seconds until the next check."""
+        with open(self.secret_file, "r") as f:
+            secrets = json.load(f)
+        sessions = load_sessions(self.session_file)
+
+        updates = {}
+        for id in secrets:
+            # companies that failed recently wait for their backoff, not for the token expiry
+            if id in self.retry_at and datetime.now(timezone.utc) < self.retry_at[id]:
+                continue
+            session = sessions.get(id)
+            try:
+                new_session = ensure_session(self.BASE, secrets[id], session, name=id, margin=self.margin, quiet=self.quiet)
+                error = None if new_session else "brak tokena w odpowiedzi KSeF"
+            except Exception as e:
+                new_session = None
+                error = str(e)
+            if error:
+                self._failed(id, error)
+                continue
+            self.failed.pop(id, None)
+            self.failures.pop(id, None)
+            self.retry_at.pop(id, None)
+            if new_session is not session:
+                updates[id] = new_session
+            sessions[id] = new_session
+        if updates:
+            update_sessions(self.session_file, updates)
+
+        # sleep until the earliest token needs renewing or failed company may be retried
+        now = datetime.now(timezone.utc)
+        wait = self.interval
+        for id in secrets:
+            if id in self.retry_at:
+                due = self.retry_at[id] - now
+            else:
+                valid_until = (sessions.get(id) or {}).get("validUntil")
+                if not valid_until:
+                    wait = min(wait, RETRY_INTERVAL)
+                    continue
+                due = parse_timestamp(valid_until) - self.margin - now
+            wait = min(wait, max(due.total_seconds(), 1))
+        return wait
+
+    def _failed(self, id, error):
+        """Record failed renewal of company `id` and schedule its retry with exponential backoff."""
+        failures = self.failures.get(id, 0) + 1
+        delay = min(RETRY_INTERVAL * 2 ** (failures - 1), MAX_RETRY_INTERVAL)
+        self.failures[id] = failures
+        self.failed[id] = error
+        self.retry_at[id] = datetime.now(timezone.utc) + timedelta(seconds=delay)
+        print(f"Nie udało się odnowić tokena {id}: {error}. Ponowna próba za {delay}s.")
@@ -1,154 +1,236 @@
-import requests
 import json
-import re
 import base64
-from Cryptodome.Hash import SHA256
-from Cryptodome.PublicKey import RSA
-from Cryptodome.Cipher import PKCS1_OAEP
-from datetime import datetime, timezone
+from datetime import datetime, timedelta, timezone
 import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from time import sleep
+from api.client import get_client
+from authentication import certificate
+from authentication.access import refresh_access_token
 
 DEBUG = False
 
-def start_multi_session(BASE, secret_file, session_file="session.json"):
+AUTH_MAX_WORKERS = 8      # ile firm uwierzytelniać równolegle
+AUTH_DEADLINE = 60        # maksymalny czas oczekiwania na autoryzację jednej firmy (s)
+POLL_INITIAL_DELAY = 0.1  # pierwsze opóźnienie sprawdzania statusu (s), potem x2
+POLL_MAX_DELAY = 2.0
+# fragmenty opisu błędu 400 oznaczające, że KSeF nie odszyfrował tokena (np. po zmianie klucza)
+ENCRYPTION_ERROR_MARKERS = ("odszyfr", "deszyfr", "decrypt")
+
+# serializes access to session files (background renewer and callers)
+_session_lock = threading.Lock()
+
+def start_multi_session(BASE, secret_file, session_file="session.json", max_workers=AUTH_MAX_WORKERS, return_report=False):
+    """Ensure valid sessions for all companies from `secret_file`, authenticating them concurrently.
+
+    With `return_report=True` returns (sessions, report) where report maps company to
+    {"ok": bool, "seconds": float, "error": str | None}.
+    """
     if not os.path.exists(secret_file):
         raise Exception(f"Nie znaleziono pliku {secret_file}")
 
     with open(secret_file, "r") as f:
         secrets = json.load(f)
     
-    if not os.path.exists(session_file):
-        session = {}
-        for id in secrets:
-            new_session = authenticate_session(BASE, secrets[id])
-            if new_session: session[id] = new_session
-        
-    else: 
-        with open(session_file, "r") as f:
-            session = json.load(f)
-        for id in secrets:
-            # Sprawdź czy sesja dla tego id istnieje
-            if id not in session:
-                new_session = authenticate_session(BASE, secrets[id])
-                if new_session: session[id] = new_session
-                continue
-            
-            # Sprawdź zy sesja dla tego id jest nadal ważna
-            ts = datetime.fromisoformat(session[id].get("validUntil"))
-            now = datetime.now(timezone.utc)
-            if ts < now:
-                new_session = authenticate_session(BASE, secrets[id])
-                if new_session: session[id] = new_session
-                continue
-                
-            print(f"Token {id} jest nadal ważny.")
-
-    with open(session_file, "w") as f:
-        json.dump(session, f)
-    return session
+    session = load_sessions(session_file)
+    report = {}
+
+    def renew(id):
+        start = time.monotonic()
+        try:
+            new_session = ensure_session(BASE, secrets[id], session.get(id), name=id)
+            error = None if new_session else "Nie można uzyskać access tokena"
+        except Exception as e:
+            new_session, error = None, str(e)
+        report[id] = {"ok": error is None, "seconds": round(time.monotonic() - start, 3), "error": error}
+        return id, new_session
+
+    updates = {}
+    with ThreadPoolExecutor(max_workers=max(max_workers, 1)) as pool:
+        for id, new_session in pool.map(renew, secrets):
+            if new_session and new_session is not session.get(id): updates[id] = new_session
+
+    report = {id: report[id] for id in secrets}
+    for id, result in report.items():
+        if not result["ok"]:
+            print(f"Uwierzytelnianie {id} nieudane po {result['seconds']}s: {result['error']}")
+
+    sessions = update_sessions(session_file, updates)
+    if return_report:
+        return sessions, report
+    return sessions
 
 def start_session(BASE, secret_file, session_file="session.json", company_name=None):
     if not os.path.exists(secret_file):
         raise Exception(f"Nie znaleziono pliku {secret_file}")
 
     with open(secret_file, "r") as f:
-        secret_ = json.load(f)
-        if company_name:
-            secret = secret_.get(company_name)
-            if not secret_:
-                raise Exception(f"Nie znaleziono danych dla firmy {company_name} w pliku {secret_file}")
-            else:
-                secret = secret_.copy()
-    
-    if not os.path.exists(session_file):
-        session = authenticate_session(BASE, secret, session_file)
+        secret = json.load(f)
+    if company_name:
+        secret = secret.get(company_name)
+        if not secret:
+            raise Exception(f"Nie znaleziono danych dla firmy {company_name} w pliku {secret_file}")
+
+    session_ = load_sessions(session_file)
+    if company_name:
+        session = ensure_session(BASE, secret, session_.get(company_name), name=company_name)
+        if session and session is not session_.get(company_name):
+            update_sessions(session_file, {company_name: session})
     else:
-        with open(session_file, "r") as f:
-            session_ = json.load(f)
-            if company_name: session = session_.get(company_name)
-            else: session = session_.copy()
-
-            ts = datetime.fromisoformat(session.get("validUntil"))
-            now = datetime.now(timezone.utc)
-            if ts < now:
-                print("Token wygasł. Uzyskiwanie nowego tokena...")
-                session = authenticate_session(BASE, secret, session_file)
-            else:
-                print("Token jest nadal ważny.")
-                
-    with open(session_file, "w") as f:
-        if company_name:
-            session_[company_name] = session
-            json.dump(session_, f)
-        else:
-            json.dump(session, f)
+        session = ensure_session(BASE, secret, session_ or None)
+        if session is not session_:
+            with _session_lock:
+                _write_sessions(session_file, session)
     return session
 
 
-def authenticate_session(BASE, secret):
+def load_sessions(session_file):
+    with _session_lock:
+        if not os.path.exists(session_file):
+            return {}
+        with open(session_file, "r") as f:
+            return json.load(f)
+
+def update_sessions(session_file, updates):
+    """Merge `updates` ({company: session}) into session file and return all sessions."""
+    with _session_lock:
+        sessions = {}
+        if os.path.exists(session_file):
+            with open(session_file, "r") as f:
+                sessions = json.load(f)
+        sessions.update(updates)
+        _write_sessions(session_file, sessions)
+        return sessions
+
+def _write_sessions(session_file, sessions):
+    # write to temp file first so readers never see a partially written file
+    tmp_file = session_file + ".tmp"
+    with open(tmp_file, "w") as f:
+        json.dump(sessions, f)
+    os.replace(tmp_file, session_file)
+
+def parse_timestamp(value):
+    ts = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    if ts.tzinfo is None:
+        ts = ts.replace(tzinfo=timezone.utc)
+    return ts
+
+def _is_valid(valid_until, now=None):
+    """True if ISO timestamp `valid_until` is in the future."""
+    if not valid_until:
+        return False
+    return parse_timestamp(valid_until) > (now or datetime.now(timezone.utc))
+
+def ensure_session(BASE, secret, session=None, name="", margin=timedelta(0), quiet=False):
+    """Return a session with valid access token.
+
+    Uses the stored session if its access token is valid for at least `margin`, renews it with
+    the refresh token (one request) while the refresh token is valid, and runs the full
+    authentication only when there is no session or the refresh token has expired.
+    With `quiet` nothing is printed when the stored session is still valid.
+    The session records the company NIP (`nip`), used as the rate limit key of data requests.
+    """
+    now = datetime.now(timezone.utc)
+    nip = secret.get("NIP")
+    if session and _is_valid(session.get("validUntil"), now + margin):
+        if not quiet: print(f"Token {name} jest nadal ważny.")
+        # sesje zapisane przed dodaniem NIP - uzupełnij, żeby limity zapytań liczyły się per NIP
+        if session.get("nip") != nip:
+            session = dict(session, nip=nip)
+        return session
+
+    # sesje zapisane przed dodaniem refreshValidUntil - spróbuj odświeżyć
+    refresh_valid = session and session.get("refreshToken") and (
+        not session.get("refreshValidUntil") or _is_valid(session.get("refreshValidUntil"), now))
+    if refresh_valid:
+        accessToken, refreshToken, validUntil = refresh_access_token(BASE, session["refreshToken"], rate_key=nip)
+        if accessToken:
+            print(f"Token {name} odświeżony.")
+            new_session = dict(session)
+            new_session["accessToken"] = accessToken
+            new_session["validUntil"] = validUntil
+            new_session["nip"] = nip
+            if refreshToken: new_session["refreshToken"] = refreshToken
+            return new_session
+        print(f"Nie udało się odświeżyć tokena {name}. Ponowne uwierzytelnianie...")
+    else:
+        print(f"Token {name} wygasł. Uzyskiwanie nowego tokena...")
+
+    return authenticate_session(BASE, secret)
+
+
+def authenticate_session(BASE, secret, deadline=AUTH_DEADLINE):
     reference, auth_token = authenticate(BASE, secret)
+    # all requests of one authentication count towards the limits of its NIP context
+    nip = secret.get("NIP")
 
-    status = auth_check(BASE,reference, auth_token)
+    # poll quickly at first, then back off; give up after `deadline` seconds
+    timeout_at = time.monotonic() + deadline
+    delay = POLL_INITIAL_DELAY
+    status = auth_check(BASE,reference, auth_token, rate_key=nip)
     while status == 100:
-        sleep(1)
-        print("Oczekiwanie na autoryzację... (status 100)")
-        status = auth_check(BASE,reference, auth_token)
+        if time.monotonic() + delay > timeout_at:
+            raise Exception(f"Przekroczono czas oczekiwania na autoryzację ({deadline}s)")
+        sleep(delay)
+        if(DEBUG): print("Oczekiwanie na autoryzację... (status 100)")
+        delay = min(delay * 2, POLL_MAX_DELAY)
+        status = auth_check(BASE,reference, auth_token, rate_key=nip)
 
     if(status == 200):
-        accessToken, refreshToken, validUntil  = getAccessToken(BASE, auth_token)
+        accessToken, refreshToken, validUntil, refreshValidUntil = getAccessToken(BASE, auth_token, rate_key=nip)
         if not accessToken:
             print("Nie można uzyskać access tokena")
             return None
         new_session = {
             "accessToken": accessToken,
             "refreshToken": refreshToken,
-            "validUntil": validUntil
+            "validUntil": validUntil,
+            "refreshValidUntil": refreshValidUntil,
+            "nip": nip,
         }
 
         return new_session
 
 
 def authenticate(BASE, secret):
+    for attempt in range(2):
+        auth = _send_ksef_token(BASE, secret)
+        if auth.status_code == 202:
+            break
+        # błąd odszyfrowania oznacza zmianę klucza KSeF - pobierz certyfikat ponownie i spróbuj jeszcze raz;
+        # inne błędy 400 (zły token, NIP, żądanie) nie mają związku z certyfikatem
+        if auth.status_code == 400 and attempt == 0 and _is_encryption_error(auth):
+            if(DEBUG): print("Auth status 400, odświeżanie certyfikatu:", auth.text)
+            certificate.invalidate(BASE)
+            continue
+        raise Exception(f"Blad uwierzytelnienia ({auth.status_code}): {auth.text[:200]}")
+
+    auth_token = auth.json().get("authenticationToken").get("token")
+    reference = auth.json().get("referenceNumber")
+    # if(DEBUG): print("AccessToken:", auth_token)
+    
+    return reference, auth_token
+
+def _is_encryption_error(response):
+    text = response.text.lower()
+    return any(marker in text for marker in ENCRYPTION_ERROR_MARKERS)
+
+def _send_ksef_token(BASE, secret):
     # 1) Pobierz challenge
-    r = requests.post(f"{BASE}/auth/challenge")
+    client = get_client(BASE)
+    r = client.post("/auth/challenge", rate_key=secret.get("NIP"))
     if(DEBUG): print("Challenge status:", r.status_code)
     data = r.json()
     challenge_id = data.get("challenge")
 
     timestamp = data.get("timestampMs")
 
-    # 2) Pobierz certyfikaty publiczne
-    certs_resp = requests.get(f"{BASE}/security/public-key-certificates")
-    certs_resp.raise_for_status()
-    certs_data = certs_resp.json()
-
-    # Znajdź certyfikat z usage KsefTokenEncryption
-    pub_pem = None
-    for cert in certs_data:
-        usage = cert.get("usage", [])
-        if "KsefTokenEncryption" in usage:
-            pub_pem = cert.get("certificate")  # PEM w wersji base64 lub PEM
-            break
-
-    if not pub_pem:
-        raise Exception("Nie znaleziono certyfikatu typu KsefTokenEncryption")
-
-    # Jeśli certyfikat jest zakodowany w Base64 bez nagłówków PEM, dodaj nagłówki:
-    if "BEGIN CERTIFICATE" not in pub_pem:
-        # Dodaj nagłówki PEM
-        pub_pem = "-----BEGIN CERTIFICATE-----\n" + pub_pem + "\n-----END CERTIFICATE-----"
-
-    # print("Wybrany certyfikat KSeF:\n", pub_pem)
-
-
-    # 3) Wyodrębnij klucz publiczny i szyfruj challenge
-    pem_body = re.sub(r"-----.*?-----", "", pub_pem, flags=re.S)
-    der_bytes = base64.b64decode(pem_body)
-
-    key = RSA.import_key(der_bytes)
-    cipher = PKCS1_OAEP.new(key, hashAlgo=SHA256)
+    # 2) Klucz publiczny KsefTokenEncryption (z pamięci podręcznej, pobierany tylko gdy wygasł)
+    cipher = certificate.get_cipher(BASE, certificate.TOKEN_ENCRYPTION)
 
+    # 3) Szyfruj token z challenge
     token_time = secret.get("token")+'|'+str(timestamp)
 
     encrypted = cipher.encrypt(token_time.encode("utf-8"))
@@ -156,7 +238,7 @@ def authenticate(BASE, secret):
 
     # print("Encrypted (base64):", encrypted_b64)
 
-    # 3) Poprawne uwierzytelnienie
+    # 4) Poprawne uwierzytelnienie
     body = {
         "challenge": challenge_id,
         "contextIdentifier": {
@@ -166,8 +248,9 @@ def authenticate(BASE, secret):
         "encryptedToken": encrypted_b64
     }
 
-    auth = requests.post(
-        f"{BASE}/auth/ksef-token",
+    return client.post(
+        "/auth/ksef-token",
+        rate_key=secret.get("NIP"),
         json=body,
         headers={
             "Content-Type": "application/json",
@@ -175,28 +258,20 @@ def authenticate(BASE, secret):
         }
     )
 
-    if auth.status_code != 202:
-        raise Exception("Blad uwierzytelnienia")
-
-    auth_token = auth.json().get("authenticationToken").get("token")
-    reference = auth.json().get("referenceNumber")
-    # if(DEBUG): print("AccessToken:", auth_token)
-    
-    return reference, auth_token
-
-def auth_check(BASE, reference, auth_token):
+def auth_check(BASE, reference, auth_token, rate_key=None):
     headers = {
         "Content-Type": "application/json",
-        "Authorization": "Bearer "+str(auth_token),
     }
     body = {
         "subjectType": "Subject1",
     }
 
-    auth = requests.get(
-        BASE+"/auth/"+str(reference),
+    auth = get_client(BASE).get(
+        "/auth/"+str(reference),
+        auth_token=auth_token,
         headers=headers,
-        data=body
+        data=body,
+        rate_key=rate_key
     )
     status = auth.json().get("status")
     if(DEBUG): print("\nAuthorisation:")
@@ -205,22 +280,22 @@ def auth_check(BASE, reference, auth_token):
 
     return status.get("code")
 
-def getAccessToken(BASE, auth_token):
+def getAccessToken(BASE, auth_token, rate_key=None):
     headers = {
         "Content-Type": "application/json",
-        "Authorization": "Bearer "+str(auth_token),
     }
-    tokens = requests.post(f"{BASE}/auth/token/redeem", headers=headers)
+    tokens = get_client(BASE).post("/auth/token/redeem", auth_token=auth_token, headers=headers, rate_key=rate_key)
     if(DEBUG): print("\nAccessToken:")
     if(DEBUG): print("Status code:",tokens.status_code)
 
     if(tokens.status_code != 200):
         print(tokens.text)
-        return None, None, None
+        return None, None, None, None
     
     accessToken = tokens.json().get("accessToken").get("token")
     refreshToken = tokens.json().get("refreshToken").get("token")
     validUntil = tokens.json().get("accessToken").get("validUntil")
+    refreshValidUntil = tokens.json().get("refreshToken").get("validUntil")
 
     print("validUntil:", validUntil)
-    return accessToken, refreshToken, validUntil
\ No newline at end of file
+    return accessToken, refreshToken, validUntil, refreshValidUntil
\ No newline at end of file
@@ -0,0 +1,28 @@
+import sys
+from authentication.token import start_session
+from invoice.export import backfill
+from api.client import get_client
+from db.sqlite import Database
+from db.documents import DocumentStore
+BASE = "https://api.ksef.mf.gov.pl/v2"
+# BASE = "https://api-test.ksef.mf.gov.pl/v2"
+
+tokenfilename = "data/secret.json"
+sessionFilename = "data/session.json"
+
+# Uzupełnienie historii przez eksport paczek KSeF zamiast pobierania faktur pojedynczo.
+# Użycie: python backfill.py <firma> <od, np. 2025-01-01T00:00:00> [Subject1|Subject2|...]
+if __name__ == "__main__":
+    company = sys.argv[1]
+    from_date = sys.argv[2]
+    subjects = sys.argv[3:] or ["Subject1", "Subject2"]
+
+    session = start_session(BASE, tokenfilename, sessionFilename, company_name=company)
+    auth_token = session.get("accessToken")
+
+    db = Database("data/ksef.db", table_names=company)
+    store = DocumentStore("data/ksef.db")
+    for subject in subjects:
+        inserted, stored = backfill(BASE, auth_token, db, store, company, subject, from_date, rate_key=session.get("nip"))
+        print(f"{company} {subject}: nowych faktur {inserted}, zapisanych XML {stored}")
+    print("KSeF HTTP:", get_client(BASE).stats())
@@ -0,0 +1,269 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import statistics
+import subprocess
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta, timezone
+from authentication import certificate
+from authentication.token import start_multi_session
+from db.sqlite import Database
+from fake_ksef_server import FakeKsefConfig, start_fake_server
+from invoice.dataframe import get_invoices_df
+from invoice.mock import iter_fake_batches
+
+# Pomiary wydajności najczęściej używanych ścieżek na wygenerowanych danych i lokalnym serwerze KSeF.
+# Uruchomienie z katalogu repozytorium:
+#   python -m benchmarks.run                       # 10k i 100k wierszy
+#   python -m benchmarks.run --rows 1000000 --only ingest query
+# Wyniki są dopisywane do benchmarks/results.jsonl z numerem rewizji git,
+# a każdy pomiar jest porównywany z ostatnim wynikiem innej rewizji.
+
+DEFAULT_ROWS = [10_000, 100_000]
+RESULTS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results.jsonl")
+BENCHMARKS = ["ingest", "query", "sellers", "dataframe", "auth"]
+SUBJECT = "Subject1"
+TABLE = "bench"
+SEED = 1
+DAYS = 365
+BATCH_SIZE = 5000
+REGRESSION_RATIO = 1.2   # p50 gorsze o 20% względem poprzedniej rewizji = regresja
+AUTH_COMPANIES = 8
+
+
+def git_revision():
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    try:
+        revision = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=root, capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=root, capture_output=True, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+    return revision + ("-dirty" if dirty else "")
+
+
+def summarize(benchmark, case, rows, durations, items=None):
+    """Result record: latency percentiles in ms and throughput in items (default: calls) per second."""
+    ordered = sorted(durations)
+    total = sum(ordered)
+    p95 = ordered[min(len(ordered) - 1, int(round(0.95 * (len(ordered) - 1))))]
+    return {
+        "benchmark": benchmark,
+        "case": case,
+        "rows": rows,
+        "runs": len(ordered),
+        "p50_ms": round(statistics.median(ordered) * 1000, 3),
+        "p95_ms": round(p95 * 1000, 3),
+        "min_ms": round(ordered[0] * 1000, 3),
+        "max_ms": round(ordered[-1] * 1000, 3),
+        "throughput": round((items if items is not None else len(ordered)) / total, 1) if total else None,
+    }
+
+def measure(fn, repeat, warmup=1):
+    for _ in range(warmup):
+        fn()
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        durations.append(time.perf_counter() - start)
+    return durations
+
+
+def bench_ingest(db, rows):
+    """Bulk upsert of generated metadata; generation is not timed. Latency is per batch."""
+    durations = []
+    for batch in iter_fake_batches(SUBJECT, rows, BATCH_SIZE, seed=SEED, days=DAYS):
+        start = time.perf_counter()
+        db.upsert_invoices(batch, SUBJECT, table=TABLE)
+        durations.append(time.perf_counter() - start)
+    db.optimize()
+    # część faktur opłacona, aby filtry statusu płatności miały co zwracać
+    db.execute(f"UPDATE {TABLE} SET is_paid = 1 WHERE id % 3 = 0;")
+    return [summarize("ingest", "upsert_invoices", rows, durations, items=rows)]
+
+
+def query_cases(db):
+    last_day = db.fetch(f"SELECT MAX(invoice_date) FROM {TABLE};")[0][0]
+    month_ago = (datetime.fromisoformat(last_day) - timedelta(days=30)).date().isoformat()
+    top_seller = db.fetch(f"SELECT seller_name FROM {TABLE} GROUP BY seller_name ORDER BY COUNT(*) DESC LIMIT 1;")[0][0]
+    return {
+        "all": {},
+        "last_30_days": {"date_from": month_ago, "date_to": last_day},
+        "price_range": {"price_min": 1000, "price_max": 5000},
+        "only_paid": {"only_paid": True},
+        "seller": {"seller_name": top_seller},
+        "type_kor": {"invoice_type": "Kor"},
+        "combined": {"date_from": month_ago, "date_to": last_day, "price_min": 100, "invoice_type": "Vat"},
+    }
+
+def bench_query(db, rows, repeat):
+    results = []
+    for case, filters in query_cases(db).items():
+        durations = measure(lambda: db.query_raw_with_filters(SUBJECT, table=TABLE, **filters), repeat)
+        results.append(summarize("query_raw_with_filters", case, rows, durations))
+        durations = measure(lambda: db.query_columns_with_filters(SUBJECT, table=TABLE, **filters), repeat)
+        results.append(summarize("query_columns_with_filters", case, rows, durations))
+    return results
+
+def bench_sellers(db, rows, repeat):
+    durations = measure(lambda: db.get_unique_sellers(SUBJECT, table=TABLE), repeat)
+    return [summarize("get_unique_sellers", "all", rows, durations)]
+
+def peak_memory(fn):
+    """Peak memory in MB allocated by Python while running `fn` once (tracemalloc, untimed run)."""
+    tracemalloc.start()
+    try:
+        fn()
+        return round(tracemalloc.get_traced_memory()[1] / 1e6, 1)
+    finally:
+        tracemalloc.stop()
+
+def bench_dataframe(db, rows, repeat):
+    results = []
+    cases = query_cases(db)
+    cases["only_unpaid"] = {"only_unpaid": True}
+    for case in ["all", "last_30_days", "seller", "only_unpaid"]:
+        filters = cases[case]
+        fn = lambda: get_invoices_df(db, SUBJECT, table=TABLE, **filters)
+        result = summarize("get_invoices_df", case, rows, measure(fn, repeat))
+        result["peak_mb"] = peak_memory(fn)
+        results.append(result)
+    return results
+
+
+def bench_auth(work_dir, repeat, latency):
+    """Concurrent authentication of AUTH_COMPANIES companies against the fake server.
+
+    `full` runs the whole challenge/token/poll/redeem flow, `refresh` only refreshes access
+    tokens and `cached` reuses still valid sessions. Latency is per company.
+    """
+    server = start_fake_server(FakeKsefConfig(invoices=0, latency=latency))
+    BASE = server.base_url
+    secret_file = os.path.join(work_dir, "secret.json")
+    session_file = os.path.join(work_dir, "session.json")
+    secrets = {f"firma{i}": {"NIP": f"{5260000000 + i}", "token": f"token-{i}"} for i in range(AUTH_COMPANIES)}
+    with open(secret_file, "w") as f:
+        json.dump(secrets, f)
+    # certyfikaty z serwera testowego nie mogą trafić do data/certificates.json
+    certificate.get_cipher(BASE, certificate.TOKEN_ENCRYPTION, cache_file=os.path.join(work_dir, "certificates.json"))
+
+    def expire_sessions():
+        with open(session_file) as f:
+            sessions = json.load(f)
+        for session in sessions.values():
+            session["validUntil"] = "2000-01-01T00:00:00+00:00"
+        with open(session_file, "w") as f:
+            json.dump(sessions, f)
+
+    results = []
+    for case in ["full", "refresh", "cached"]:
+        per_company = []
+        durations = []
+        for _ in range(repeat):
+            if case == "full" and os.path.exists(session_file):
+                os.remove(session_file)
+            elif case == "refresh":
+                expire_sessions()
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                _, report = start_multi_session(BASE, secret_file, session_file, return_report=True)
+            durations.append(time.perf_counter() - start)
+            failed = [id for id, r in report.items() if not r["ok"]]
+            if failed:
+                raise Exception(f"Uwierzytelnianie nieudane: {failed}")
+            per_company.extend(r["seconds"] for r in report.values())
+        result = summarize("auth", case, 0, per_company, items=AUTH_COMPANIES * repeat)
+        result["throughput"] = round(AUTH_COMPANIES * repeat / sum(durations), 1)
+        result["total_p50_ms"] = round(statistics.median(durations) * 1000, 3)
+        results.append(result)
+    server.shutdown()
+    server.server_close()
+    return results
+
+
+def load_results(path):
+    if not os.path.exists(path):
+        return []
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def compare(result, previous):
+    """Return (previous p50, ratio) from the latest result of another revision with the same key, or None."""
+    key = (result["benchmark"], result["case"], result["rows"])
+    for old in reversed(previous):
+        if (old["benchmark"], old["case"], old["rows"]) == key and old.get("revision") != result["revision"]:
+            return old["p50_ms"], (result["p50_ms"] / old["p50_ms"] if old["p50_ms"] else None)
+    return None
+
+def report(result, previous):
+    line = (f"{result['benchmark']:<24} {result['case']:<16} {result['rows']:>9} "
+            f"p50 {result['p50_ms']:>10.3f} ms  p95 {result['p95_ms']:>10.3f} ms  {result['throughput'] or 0:>12.1f}/s")
+    if "peak_mb" in result:
+        line += f"  peak {result['peak_mb']:.1f} MB"
+    found = compare(result, previous)
+    if found and found[1]:
+        old_p50, ratio = found
+        flag = "  REGRESJA" if ratio > REGRESSION_RATIO else ""
+        line += f"  (poprzednio {old_p50:.3f} ms, x{ratio:.2f}){flag}"
+    print(line, flush=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarki simple-ksef")
+    parser.add_argument("--rows", type=int, nargs="+", default=DEFAULT_ROWS, help="liczby wierszy, np. 10000 100000 1000000")
+    parser.add_argument("--only", nargs="+", choices=BENCHMARKS, default=BENCHMARKS)
+    parser.add_argument("--repeat", type=int, default=5, help="powtórzeń każdego zapytania")
+    parser.add_argument("--latency", type=float, default=0.005, help="opóźnienie serwera testowego dla auth (s)")
+    parser.add_argument("--results", default=RESULTS_FILE)
+    parser.add_argument("--no-save", action="store_true", help="nie zapisuj wyników")
+    args = parser.parse_args()
+
+    meta = {
+        "revision": git_revision(),
+        "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+    }
+    previous = load_results(args.results)
+    results = []
+
+    def record(items):
+        for item in items:
+            item.update(meta)
+            report(item, previous)
+            results.append(item)
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        db_benchmarks = [b for b in args.only if b != "auth"]
+        for rows in args.rows if db_benchmarks else []:
+            db = Database(os.path.join(work_dir, f"bench_{rows}.db"), table_names=TABLE)
+            # przy milionie wierszy wystarczy mniej powtórzeń
+            repeat = args.repeat if rows <= 100_000 else max(1, args.repeat // 2)
+            if "ingest" in args.only:
+                record(bench_ingest(db, rows))
+            else:
+                bench_ingest(db, rows)
+            if "query" in args.only:
+                record(bench_query(db, rows, repeat))
+            if "sellers" in args.only:
+                record(bench_sellers(db, rows, repeat))
+            if "dataframe" in args.only:
+                record(bench_dataframe(db, rows, repeat))
+            db.close()
+        if "auth" in args.only:
+            record(bench_auth(work_dir, args.repeat, args.latency))
+
+    if not args.no_save:
+        with open(args.results, "a", encoding="utf-8") as f:
+            for item in results:
+                f.write(json.dumps(item, ensure_ascii=False) + "\n")
+        print(f"Zapisano {len(results)} wyników do {args.results}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+import sqlite3
+import threading
+import time
+
+BATCH_MAX_ROWS = 5000     # zatwierdź transakcję po tylu zapisanych wierszach
+BATCH_MAX_SECONDS = 1.0   # albo gdy najstarszy oczekujący zapis czeka tyle sekund
+
+
+class BatchWriteError(Exception):
+    """Flush failed and the whole batch was rolled back; `tags` identify the writes that were lost."""
+
+    def __init__(self, tags, cause):
+        super().__init__(f"Błąd zapisu partii do bazy: {cause}")
+        self.tags = tags
+        self.cause = cause
+
+
+class WriteBatcher:
+    """Groups writes to a Database into explicit transactions.
+
+    Writes are queued and committed together in one `BEGIN IMMEDIATE` transaction when
+    `max_rows` rows are pending or the oldest pending write is `max_seconds` old (checked on
+    each write), and on `flush()`. Consecutive writes with the same statement run as one
+    executemany. Rows rejected by a constraint are skipped and kept in `rejected`.
+
+    Each write may carry a `tag` (e.g. (company, subject)); if a flush fails, BatchWriteError
+    lists the tags of the rolled back writes. Safe to share between threads.
+    """
+
+    def __init__(self, db, max_rows=BATCH_MAX_ROWS, max_seconds=BATCH_MAX_SECONDS):
+        self.db = db
+        self.max_rows = max_rows
+        self.max_seconds = max_seconds
+        self.pending = []       # [query, [params...], count_inserted, [tags...]]
+        self.pending_rows = 0
+        self.first_pending = None
+        self.rejected = []      # (tag, params or invoice dict that could not be converted, error)
+        self.transactions = 0
+        self.rows = 0
+        self.inserted = 0
+        self.lock_wait = 0.0
+        # guards the pending writes; taken before Database.lock, never the other way round
+        self.lock = threading.RLock()
+
+    def add(self, query, params, tag=None, count=False):
+        return self.add_many(query, [params], tag, count)
+
+    def add_many(self, query, rows, tag=None, count=False):
+        """Queue statement for each params tuple in `rows`. Returns rows inserted by a flush this triggered."""
+        rows = list(rows)
+        if not rows:
+            return 0
+        with self.lock:
+            return self._add(query, rows, tag, count)
+
+    def _add(self, query, rows, tag, count):
+        if self.pending and self.pending[-1][0] == query and self.pending[-1][2] == count:
+            self.pending[-1][1].extend(rows)
+            self.pending[-1][3].extend([tag] * len(rows))
+        else:
+            self.pending.append([query, rows, count, [tag] * len(rows)])
+        if self.first_pending is None:
+            self.first_pending = time.monotonic()
+        self.pending_rows += len(rows)
+        if self.pending_rows >= self.max_rows or time.monotonic() - self.first_pending >= self.max_seconds:
+            return self._flush()
+        return 0
+
+    def insert_invoices(self, invoices, subject, table, tag=None):
+        """Queue invoices for insertion, skipping ones already stored (see Database.upsert_invoices).
+
+        Invoices with malformed metadata are not queued but added to `rejected`.
+        """
+        rows = []
+        for invoice in invoices:
+            try:
+                rows.append(self.db._invoice_row(invoice, subject))
+            except Exception as e:
+                self.rejected.append((tag, invoice, f"Niepoprawne dane faktury: {e!r}"))
+        return self.add_many(self.db._upsert_query(table), rows, tag, count=True)
+
+    def flush(self):
+        """Commit pending writes in one transaction. Returns number of inserted rows."""
+        with self.lock:
+            return self._flush()
+
+    def _flush(self):
+        if not self.pending:
+            return 0
+        pending, self.pending = self.pending, []
+        rows, self.pending_rows, self.first_pending = self.pending_rows, 0, None
+        stats = {"lock_wait": 0.0}
+        inserted = 0
+        try:
+            with self.db._transaction(stats) as cur:
+                for query, params, count, tags in pending:
+                    inserted += self._execute(cur, query, params, count, tags)
+        except Exception as e:
+            raise BatchWriteError(sorted({t for *_, tags in pending for t in tags if t is not None}, key=str), e) from e
+        finally:
+            self.lock_wait += stats["lock_wait"]
+        self.transactions += 1
+        self.rows += rows
+        self.inserted += inserted
+        return inserted
+
+    def _execute(self, cur, query, params, count, tags):
+        before = self.db.con.total_changes
+        cur.execute("SAVEPOINT batch_step;")
+        try:
+            cur.executemany(query, params)
+            cur.execute("RELEASE batch_step;")
+        except sqlite3.IntegrityError:
+            # undo this group only and replay it row by row, skipping rows that violate constraints
+            cur.execute("ROLLBACK TO batch_step;")
+            cur.execute("RELEASE batch_step;")
+            before = self.db.con.total_changes
+            for row, tag in zip(params, tags):
+                try:
+                    cur.execute(query, row)
+                except sqlite3.IntegrityError as e:
+                    self.rejected.append((tag, row, str(e)))
+        return self.db.con.total_changes - before if count else 0
+
+    def stats(self) -> dict:
+        return {
+            "transactions": self.transactions,
+            "rows": self.rows,
+            "inserted": self.inserted,
+            "rejected": len(self.rejected),
+            "lock_wait": round(self.lock_wait, 3),
+        }
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.flush()
+        else:
+            with self.lock:
+                self.pending, self.pending_rows, self.first_pending = [], 0, None
@@ -0,0 +1,242 @@
+import hashlib
+import sqlite3
+import zlib
+from monitoring.metrics import TimedLock, instrumented
+
+COMPRESS_LEVEL = 6
+READ_CHUNK = 64 * 1024
+IN_BATCH = 500 # max parameters in one IN (...) query
+
+
+@instrumented("document_store")
+class DocumentStore:
+    """Content-addressed store of invoice XML documents kept as zlib blobs in SQLite.
+
+    `documents` holds each distinct content once (keyed by SHA-256), `document_refs` maps
+    KSeF numbers to content hashes, so the same invoice seen by several companies is stored once.
+    """
+
+    def __init__(self, file_path: str = "database.db"):
+        self.con = sqlite3.connect(file_path, check_same_thread=False, timeout=30.0)
+        self.cur = self.con.cursor()
+        self.lock = TimedLock()
+        self.__create_tables()
+
+    def __create_tables(self):
+        create_documents_table = """
+        CREATE TABLE IF NOT EXISTS documents (
+            hash CHAR(64) PRIMARY KEY,
+            size INTEGER NOT NULL,
+            data BLOB NOT NULL
+        );
+        """
+        create_refs_table = """
+        CREATE TABLE IF NOT EXISTS document_refs (
+            ksef CHAR(35) PRIMARY KEY,
+            hash CHAR(64) NOT NULL REFERENCES documents(hash)
+        );
+        """
+        # data parsed from the XML (invoice.parser), one parse per stored invoice
+        create_parsed_tables = [
+            """
+            CREATE TABLE IF NOT EXISTS parsed_documents (
+                ksef CHAR(35) PRIMARY KEY,
+                hash CHAR(64) NOT NULL,
+                parser_version INTEGER NOT NULL,
+                error TEXT
+            );
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS invoice_lines (
+                ksef CHAR(35) NOT NULL,
+                line_no INTEGER,
+                name VARCHAR(512),
+                unit VARCHAR(32),
+                quantity DECIMAL(16, 6),
+                unit_net_price DECIMAL(16, 8),
+                net_amount DECIMAL(16, 2),
+                gross_amount DECIMAL(16, 2),
+                vat_rate VARCHAR(10)
+            );
+            """,
+            "CREATE INDEX IF NOT EXISTS ix_invoice_lines_ksef ON invoice_lines (ksef);",
+            """
+            CREATE TABLE IF NOT EXISTS invoice_vat_totals (
+                ksef CHAR(35) NOT NULL,
+                vat_rate VARCHAR(10) NOT NULL,
+                net_amount DECIMAL(16, 2),
+                vat_amount DECIMAL(16, 2),
+                PRIMARY KEY (ksef, vat_rate)
+            );
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS invoice_payment_terms (
+                ksef CHAR(35) NOT NULL,
+                due_date DATE NOT NULL
+            );
+            """,
+            "CREATE INDEX IF NOT EXISTS ix_invoice_payment_terms_ksef ON invoice_payment_terms (ksef, due_date);",
+        ]
+        with self.lock:
+            self.cur.execute(create_documents_table)
+            self.cur.execute(create_refs_table)
+            for query in create_parsed_tables:
+                self.cur.execute(query)
+            self.con.commit()
+
+    def put_stream(self, ksef_number, chunks) -> str:
+        """Store document read from iterable of byte chunks. Returns its content hash."""
+        digest = hashlib.sha256()
+        compressor = zlib.compressobj(COMPRESS_LEVEL)
+        parts = []
+        size = 0
+        for chunk in chunks:
+            if not chunk:
+                continue
+            digest.update(chunk)
+            parts.append(compressor.compress(chunk))
+            size += len(chunk)
+        parts.append(compressor.flush())
+        content_hash = digest.hexdigest()
+
+        with self.lock:
+            try:
+                self.cur.execute("INSERT OR IGNORE INTO documents (hash, size, data) VALUES (?, ?, ?);",
+                                 (content_hash, size, b"".join(parts)))
+                self.cur.execute("INSERT OR REPLACE INTO document_refs (ksef, hash) VALUES (?, ?);",
+                                 (ksef_number, content_hash))
+                self.con.commit()
+            except Exception:
+                self.con.rollback()
+                raise
+        return content_hash
+
+    def put(self, ksef_number, content: bytes) -> str:
+        return self.put_stream(ksef_number, [content])
+
+    def put_file(self, ksef_number, file_path) -> str:
+        with open(file_path, "rb") as f:
+            return self.put_stream(ksef_number, iter(lambda: f.read(READ_CHUNK), b""))
+
+    def get_hashes(self, ksef_numbers) -> dict:
+        """Return {ksef: hash} for those of `ksef_numbers` stored locally."""
+        ksef_numbers = list(dict.fromkeys(ksef_numbers))
+        result = {}
+        with self.lock:
+            for i in range(0, len(ksef_numbers), IN_BATCH):
+                batch = ksef_numbers[i:i + IN_BATCH]
+                placeholders = ", ".join("?" for _ in batch)
+                self.cur.execute(f"SELECT ksef, hash FROM document_refs WHERE ksef IN ({placeholders});", batch)
+                result.update(self.cur.fetchall())
+        return result
+
+    def has(self, ksef_number) -> bool:
+        return bool(self.get_hashes([ksef_number]))
+
+    def _blob(self, ksef_number):
+        query = """
+        SELECT d.data FROM document_refs r JOIN documents d ON d.hash = r.hash
+        WHERE r.ksef = ?;
+        """
+        with self.lock:
+            self.cur.execute(query, (ksef_number,))
+            row = self.cur.fetchone()
+        return row[0] if row else None
+
+    def iter_chunks(self, ksef_number, chunk_size=READ_CHUNK):
+        """Yield decompressed document in chunks, nothing if not stored."""
+        blob = self._blob(ksef_number)
+        if blob is None:
+            return
+        decompressor = zlib.decompressobj()
+        for i in range(0, len(blob), chunk_size):
+            data = decompressor.decompress(blob[i:i + chunk_size])
+            if data:
+                yield data
+        data = decompressor.flush()
+        if data:
+            yield data
+
+    def get(self, ksef_number) -> bytes | None:
+        blob = self._blob(ksef_number)
+        return zlib.decompress(blob) if blob is not None else None
+
+    def unparsed(self, parser_version, limit=500, ksef_numbers=None):
+        """Return up to `limit` (ksef, hash) of stored invoices not parsed by `parser_version`.
+
+        With `ksef_numbers` only those invoices are checked.
+        """
+        query = """
+        SELECT r.ksef, r.hash FROM document_refs r
+        LEFT JOIN parsed_documents p ON p.ksef = r.ksef
+        WHERE (p.ksef IS NULL OR p.parser_version < ? OR p.hash != r.hash){}
+        LIMIT ?;
+        """
+        if ksef_numbers is None:
+            with self.lock:
+                self.cur.execute(query.format(""), (parser_version, limit))
+                return self.cur.fetchall()
+
+        ksef_numbers = list(dict.fromkeys(ksef_numbers))
+        result = []
+        with self.lock:
+            for i in range(0, len(ksef_numbers), IN_BATCH):
+                if len(result) >= limit:
+                    break
+                batch = ksef_numbers[i:i + IN_BATCH]
+                placeholders = ", ".join("?" for _ in batch)
+                self.cur.execute(query.format(f" AND r.ksef IN ({placeholders})"),
+                                 (parser_version, *batch, limit - len(result)))
+                result.extend(self.cur.fetchall())
+        return result
+
+    def save_parsed(self, results, parser_version):
+        """Save parser output in one transaction.
+
+        `results` is a list of (ksef, hash, parsed, error) where parsed is the dict returned
+        by invoice.parser.parse_invoice (None on error).
+        """
+        ksef_numbers = [(r[0],) for r in results]
+        lines = []
+        totals = []
+        terms = []
+        for ksef_number, _, parsed, _ in results:
+            if not parsed:
+                continue
+            for line in parsed["lines"]:
+                lines.append((
+                    ksef_number, line.get("line_no"), line.get("name"), line.get("unit"), line.get("quantity"),
+                    line.get("unit_net_price"), line.get("net_amount"), line.get("gross_amount"), line.get("vat_rate"),
+                ))
+            for rate, (net, vat) in parsed["vat_totals"].items():
+                totals.append((ksef_number, rate, net, vat))
+            for due_date in parsed["due_dates"]:
+                terms.append((ksef_number, due_date))
+
+        with self.lock:
+            try:
+                # replace results of an older parser version
+                self.cur.executemany("DELETE FROM invoice_lines WHERE ksef = ?;", ksef_numbers)
+                self.cur.executemany("DELETE FROM invoice_vat_totals WHERE ksef = ?;", ksef_numbers)
+                self.cur.executemany("DELETE FROM invoice_payment_terms WHERE ksef = ?;", ksef_numbers)
+                self.cur.executemany("""
+                INSERT INTO invoice_lines (ksef, line_no, name, unit, quantity, unit_net_price, net_amount, gross_amount, vat_rate)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?);
+                """, lines)
+                self.cur.executemany("INSERT INTO invoice_vat_totals (ksef, vat_rate, net_amount, vat_amount) VALUES (?, ?, ?, ?);", totals)
+                self.cur.executemany("INSERT INTO invoice_payment_terms (ksef, due_date) VALUES (?, ?);", terms)
+                self.cur.executemany("""
+                INSERT OR REPLACE INTO parsed_documents (ksef, hash, parser_version, error) VALUES (?, ?, ?, ?);
+                """, [(k, h, parser_version, error) for k, h, _, error in results])
+                self.con.commit()
+            except Exception:
+                self.con.rollback()
+                raise
+
+    def stats(self) -> dict:
+        with self.lock:
+            self.cur.execute("SELECT COUNT(*), COALESCE(SUM(size), 0), COALESCE(SUM(LENGTH(data)), 0) FROM documents;")
+            documents, raw_bytes, stored_bytes = self.cur.fetchone()
+            self.cur.execute("SELECT COUNT(*) FROM document_refs;")
+            refs = self.cur.fetchone()[0]
+        return {"documents": documents, "invoices": refs, "raw_bytes": raw_bytes, "stored_bytes": stored_bytes}
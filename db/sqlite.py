@@ -1,17 +1,96 @@
+import queue
 import sqlite3
 import threading
 import time
+from contextlib import contextmanager
+from db.batch import WriteBatcher, BATCH_MAX_ROWS, BATCH_MAX_SECONDS
+from monitoring.metrics import REGISTRY, TimedLock, instrumented, add_lock_wait
 
 DEFULT_NAME = "invoices"
+OPTIMIZE_AFTER_ROWS = 1000 # run ANALYZE after syncs inserting at least this many rows
+BUSY_TIMEOUT = 30.0        # s, SQLite waits this long for a lock held by another connection
+READ_POOL_SIZE = 4         # read-only connections used concurrently with the writer (WAL)
+FETCH_ROWS = 10000         # rows fetched at once by query_columns_with_filters
 
+
+def _migrate_unique_ksef(cur, table):
+    """v1: remove duplicated (ksef, subject) rows and add UNIQUE index on them."""
+    index = f"ux_{table}_ksef_subject"
+    cur.execute("SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = ?;", (index,))
+    if cur.fetchone():
+        return
+    # keep paid status if any of the duplicates was marked as paid
+    cur.execute(f"""
+    UPDATE {table} SET is_paid = 1
+    WHERE NOT is_paid AND EXISTS (
+        SELECT 1 FROM {table} AS d
+        WHERE d.ksef = {table}.ksef AND d.subject = {table}.subject AND d.is_paid
+    );
+    """)
+    cur.execute(f"DELETE FROM {table} WHERE id NOT IN (SELECT MIN(id) FROM {table} GROUP BY ksef, subject);")
+    if cur.rowcount > 0:
+        print(f"Usunięto {cur.rowcount} zduplikowanych faktur z tabeli {table}.")
+    cur.execute(f"CREATE UNIQUE INDEX {index} ON {table} (ksef, subject);")
+
+def _migrate_filter_indexes(cur, table):
+    """v2: indexes for filters used by query_raw_with_filters and get_unique_sellers."""
+    # (ksef, subject) lookups in invoice_exists / update_paid_status use the v1 unique index
+    cur.execute(f"CREATE INDEX IF NOT EXISTS ix_{table}_subject_date ON {table} (subject, invoice_date);")
+    # covers DISTINCT seller_name and seller filter ordered by date
+    cur.execute(f"CREATE INDEX IF NOT EXISTS ix_{table}_subject_seller ON {table} (subject, seller_name, invoice_date);")
+    cur.execute(f"CREATE INDEX IF NOT EXISTS ix_{table}_subject_type ON {table} (subject, type, invoice_date);")
+    cur.execute(f"CREATE INDEX IF NOT EXISTS ix_{table}_subject_gross ON {table} (subject, gross_amount);")
+
+def _migrate_document_hash(cur, table):
+    """v3: content hash of the locally stored XML (db.documents.DocumentStore), NULL if not downloaded."""
+    cur.execute(f"PRAGMA table_info({table});")
+    if "doc_hash" not in [row[1] for row in cur.fetchall()]:
+        cur.execute(f"ALTER TABLE {table} ADD COLUMN doc_hash CHAR(64);")
+
+# Migrations of invoice tables, applied in order. Version of each table (schema_versions)
+# is the number of migrations applied to it - append new ones at the end, never reorder.
+# Migrations must be idempotent: tables migrated before schema_versions existed get all of them.
+MIGRATIONS = [
+    _migrate_unique_ksef,
+    _migrate_filter_indexes,
+    _migrate_document_hash,
+]
+SCHEMA_VERSION = len(MIGRATIONS)
+
+# columns returned by query_raw_with_filters / query_columns_with_filters
+INVOICE_LIST_COLUMNS = "ksef, subject, invoice_date, invoice_number, buyer_name, seller_name, type, net_amount, gross_amount, currency, is_paid, doc_hash"
+
+SET_WATERMARK_QUERY = """
+INSERT INTO sync_state (company, subject, last_synced) VALUES (?, ?, ?)
+ON CONFLICT(company, subject) DO UPDATE SET last_synced = excluded.last_synced;
+"""
+
+
+@instrumented("db")
 class Database:
-    def __init__(self, file_path: str = "database.db", drop_tables: bool = False, table_names: str | list[str] | None = None):
-        # allow using the connection from different threads (Streamlit may run callbacks)
-        # set a generous timeout to wait for locks
-        self.con = sqlite3.connect(file_path, check_same_thread=False, timeout=30.0)
+    """Invoice database with one serialized writer connection and a pool of read-only connections.
+
+    In WAL mode readers do not wait for the writer, so queries keep running during a sync.
+    Writes from all threads go through `con` guarded by `lock`, each in an explicit
+    `BEGIN IMMEDIATE` transaction; waiting for locks held by other connections (e.g. DocumentStore
+    on the same file) is left to SQLite's busy timeout. Single-row writes (`insert_invoice`) are
+    queued in `batcher` and committed together by `commit()` or when the batch fills up.
+    """
+
+    def __init__(self, file_path: str = "database.db", drop_tables: bool = False, table_names: str | list[str] | None = None,
+                 read_pool_size: int = READ_POOL_SIZE):
+        self.file_path = file_path
+        # writer connection, used from different threads (Streamlit callbacks, sync) under the lock
+        self.con = sqlite3.connect(file_path, check_same_thread=False, timeout=BUSY_TIMEOUT)
         self.cur = self.con.cursor()
-        # simple lock to serialize DB operations
-        self.lock = threading.Lock()
+        self.lock = TimedLock()
+        self.batcher = WriteBatcher(self)
+
+        # in-memory databases are private to one connection, so readers use the writer there
+        self.read_pool_size = read_pool_size if file_path != ":memory:" and not file_path.startswith("file::memory:") else 0
+        self.readers = queue.LifoQueue()
+        self.reader_count = 0
+        self.readers_lock = threading.Lock()
 
         # normalize ids to list of strings
         if table_names is None:
@@ -24,7 +103,7 @@ class Database:
         if drop_tables: self.__drop_tables()
         self.__create_tables()
 
-        # set WAL journal mode to reduce writer contention
+        # set WAL journal mode, so readers do not block the writer and vice versa
         try:
             with self.lock:
                 self.cur.execute("PRAGMA journal_mode=WAL;")
@@ -32,6 +111,72 @@ class Database:
         except Exception:
             pass # non-fatal if pragmas can't be set
 
+    def _open_reader(self):
+        con = sqlite3.connect(self.file_path, check_same_thread=False, timeout=BUSY_TIMEOUT)
+        con.execute("PRAGMA query_only = ON;")
+        return con
+
+    @contextmanager
+    def _transaction(self, stats=None):
+        """Yield writer cursor inside a BEGIN IMMEDIATE transaction, commit on success, roll back on error.
+
+        Time spent waiting for the writer lock and for SQLite's write lock (busy timeout) is
+        recorded as lock wait and added to `stats["lock_wait"]` if given.
+        """
+        start = time.perf_counter()
+        with self.lock:
+            busy_start = time.perf_counter()
+            self.cur.execute("BEGIN IMMEDIATE;")
+            busy_wait = time.perf_counter() - busy_start
+            add_lock_wait(busy_wait)
+            REGISTRY.observe("db_busy_wait_seconds", busy_wait)
+            if stats is not None:
+                stats["lock_wait"] += time.perf_counter() - start
+            try:
+                yield self.cur
+                self.con.commit()
+            except BaseException:
+                self.con.rollback()
+                raise
+
+    def batch(self, max_rows=BATCH_MAX_ROWS, max_seconds=BATCH_MAX_SECONDS):
+        """Return a new WriteBatcher grouping writes of one job into larger transactions."""
+        return WriteBatcher(self, max_rows, max_seconds)
+
+    @contextmanager
+    def _read(self):
+        """Yield cursor of a pooled read-only connection (the writer's under the lock if pooling is off)."""
+        if not self.read_pool_size:
+            with self.lock:
+                yield self.cur
+            return
+        try:
+            con = self.readers.get_nowait()
+        except queue.Empty:
+            with self.readers_lock:
+                can_open = self.reader_count < self.read_pool_size
+                if can_open: self.reader_count += 1
+            if can_open:
+                con = self._open_reader()
+            else:
+                start = time.perf_counter()
+                con = self.readers.get()
+                add_lock_wait(time.perf_counter() - start)
+        try:
+            yield con.cursor()
+        finally:
+            self.readers.put(con)
+
+    def close(self):
+        self.batcher.flush()
+        with self.lock:
+            self.con.close()
+        while True:
+            try:
+                self.readers.get_nowait().close()
+            except queue.Empty:
+                break
+
 
     def __create_tables(self):
         create_invoice_table = """
@@ -54,9 +199,37 @@ class Database:
             is_paid BOOLEAN DEFAULT FALSE
         );  
         """
+        create_sync_state_table = """
+        CREATE TABLE IF NOT EXISTS sync_state (
+            company VARCHAR(255) NOT NULL,
+            subject VARCHAR(20) NOT NULL,
+            last_synced VARCHAR(40) NOT NULL,
+            PRIMARY KEY (company, subject)
+        );
+        """
+        create_schema_versions_table = """
+        CREATE TABLE IF NOT EXISTS schema_versions (
+            table_name VARCHAR(255) PRIMARY KEY,
+            version INTEGER NOT NULL
+        );
+        """
         with self.lock:
+            self.cur.execute(create_schema_versions_table)
+            # the version is tracked per table: a process may open the file with only some of them
             for id in self.ids:
+                self.cur.execute("SELECT version FROM schema_versions WHERE table_name = ?;", (id,))
+                row = self.cur.fetchone()
+                version = row[0] if row else 0
                 self.cur.execute(create_invoice_table.format(table=id))
+                for migration in MIGRATIONS[version:]:
+                    migration(self.cur, id)
+                if version < SCHEMA_VERSION:
+                    self.cur.execute("""
+                    INSERT INTO schema_versions (table_name, version) VALUES (?, ?)
+                    ON CONFLICT(table_name) DO UPDATE SET version = excluded.version;
+                    """, (id, SCHEMA_VERSION))
+            self.cur.execute(create_sync_state_table)
+            self.con.commit()
 
 
     def __drop_tables(self):
@@ -64,6 +237,11 @@ class Database:
             for id in self.ids:
                 drop_invoice_table = f"DROP TABLE IF EXISTS {id};"
                 self.cur.execute(drop_invoice_table)
+                self.cur.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'schema_versions';")
+                if self.cur.fetchone():
+                    self.cur.execute("DELETE FROM schema_versions WHERE table_name = ?;", (id,))
+            # without invoices the sync watermarks are no longer valid
+            self.cur.execute("DROP TABLE IF EXISTS sync_state;")
 
     def _table_name(self, name: str, allow_new: bool = False) -> str:
         """Return a safe table name for given name. Raises ValueError if subject not configured."""
@@ -78,15 +256,15 @@ class Database:
         return f"{safe}"
 
 
-    def insert_invoice(self, invoice_data, subject, table=DEFULT_NAME):
-        table = self._table_name(table)
-        insert_query = f"""
-        INSERT INTO {table} (
-            ksef, invoice_number, invoice_date, buyer_name, buyer_id,
-            seller_name, seller_nip, net_amount, gross_amount, vat_amount,
-            currency, subject, type, system_code, is_paid
-        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?);
-        """
+    INSERT_COLUMNS = """
+        ksef, invoice_number, invoice_date, buyer_name, buyer_id,
+        seller_name, seller_nip, net_amount, gross_amount, vat_amount,
+        currency, subject, type, system_code, is_paid
+    """
+
+    @staticmethod
+    def _invoice_row(invoice_data, subject):
+        """Convert KSeF invoice metadata dict to a row tuple matching INSERT_COLUMNS."""
         buyer = invoice_data.get('buyer', {})
         seller = invoice_data.get('seller', {})
 
@@ -100,86 +278,122 @@ class Database:
         if invoice_data.get('formCode'):
             system_code = invoice_data['formCode'].get('systemCode')
 
-        # try insert with retries on 'database is locked'
-        attempts = 10
-        delay = 0.1
-        for attempt in range(attempts):
-            try:
-                with self.lock:
-                    self.cur.execute(insert_query, (
-                        invoice_data.get('ksefNumber'),
-                        invoice_data.get('invoiceNumber'),
-                        invoice_data.get('issueDate'),
-                        buyer.get('name'),
-                        buyer_id,
-                        seller.get('name'),
-                        seller.get('nip'),
-                        invoice_data.get('netAmount'),
-                        invoice_data.get('grossAmount'),
-                        invoice_data.get('vatAmount'),
-                        invoice_data.get('currency'),
-                        subject,
-                        invoice_data.get('invoiceType'),
-                        system_code,
-                        False,  # is_paid default to False
-                    ))
-                break
-            except Exception as e:
-                if 'database is locked' in str(e).lower() and attempt < attempts - 1:
-                    time.sleep(delay)
-                    delay *= 2
-                    continue
-                raise
-        else:
-            if attempt <= 0:
-                raise Exception("Failed to insert invoice due to database locks.")
+        return (
+            invoice_data.get('ksefNumber'),
+            invoice_data.get('invoiceNumber'),
+            invoice_data.get('issueDate'),
+            buyer.get('name'),
+            buyer_id,
+            seller.get('name'),
+            seller.get('nip'),
+            invoice_data.get('netAmount'),
+            invoice_data.get('grossAmount'),
+            invoice_data.get('vatAmount'),
+            invoice_data.get('currency'),
+            subject,
+            invoice_data.get('invoiceType'),
+            system_code,
+            False,  # is_paid default to False
+        )
+
+    def _upsert_query(self, table):
+        table = self._table_name(table)
+        return f"""
+        INSERT INTO {table} ({self.INSERT_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT(ksef, subject) DO NOTHING;
+        """
+
+    def insert_invoice(self, invoice_data, subject, table=DEFULT_NAME):
+        """Queue invoice in the default batch; it is stored on `commit()` or when the batch fills up.
+
+        Returns number of rows inserted by a flush this call triggered (usually 0).
+        """
+        table = self._table_name(table)
+        insert_query = f"""
+        INSERT INTO {table} ({self.INSERT_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?);
+        """
+        return self.batcher.add(insert_query, self._invoice_row(invoice_data, subject), count=True)
+
+    def upsert_invoices(self, invoices, subject, table=DEFULT_NAME):
+        """Insert many invoices in one transaction, skipping ones already stored (ksef, subject).
+
+        Existing rows are left untouched, so the paid status is preserved. Returns number of inserted rows.
+        """
+        rows = (self._invoice_row(invoice, subject) for invoice in invoices)
+        with self._transaction() as cur:
+            before = self.con.total_changes
+            cur.executemany(self._upsert_query(table), rows)
+            return self.con.total_changes - before
 
     def invoice_exists(self, ksef_number, subject, table=DEFULT_NAME):
         """Check if invoice with given ksef_number already exists in database."""
         table = self._table_name(table)
         query = f"SELECT 1 FROM {table} WHERE ksef = ? AND subject = ? LIMIT 1;"
-        with self.lock:
-            self.cur.execute(query, (ksef_number, subject))
-            return self.cur.fetchone() is not None
+        with self._read() as cur:
+            cur.execute(query, (ksef_number, subject))
+            return cur.fetchone() is not None
 
 
     def commit(self):
-        # commit with retry on lock
-        attempts = 5
-        delay = 0.1
-        for attempt in range(attempts):
-            try:
-                with self.lock:
-                    self.con.commit()
-                break
-            except sqlite3.OperationalError as e:
-                if 'database is locked' in str(e).lower() and attempt < attempts - 1:
-                    time.sleep(delay)
-                    delay *= 2
-                    continue
-                raise
+        """Store writes queued in the default batch (see insert_invoice). Returns number of inserted rows."""
+        return self.batcher.flush()
+
+
+    def get_sync_watermark(self, company, subject):
+        """Return timestamp (ISO string) of last successful sync for company/subject or None."""
+        query = "SELECT last_synced FROM sync_state WHERE company = ? AND subject = ?;"
+        with self._read() as cur:
+            cur.execute(query, (company, subject))
+            row = cur.fetchone()
+        return row[0] if row else None
+
+    def set_sync_watermark(self, company, subject, timestamp):
+        """Store timestamp (ISO string) of last successful sync for company/subject."""
+        with self._transaction() as cur:
+            cur.execute(SET_WATERMARK_QUERY, (company, subject, timestamp))
+
+
+    def set_document_hashes(self, hashes, table=DEFULT_NAME):
+        """Mark invoices as stored locally: `hashes` maps ksef number to document content hash."""
+        table = self._table_name(table)
+        query = f"UPDATE {table} SET doc_hash = ? WHERE ksef = ?;"
+        with self._transaction() as cur:
+            cur.executemany(query, [(h, k) for k, h in hashes.items()])
+
+    def optimize(self):
+        """Refresh query planner statistics, e.g. after a large sync."""
+        with self._transaction() as cur:
+            cur.execute("ANALYZE;")
+            cur.execute("PRAGMA optimize;")
 
 
     def fetch(self, query, params=()):
-        with self.lock:
-            self.cur.execute(query, params)
-            return self.cur.fetchall()
+        """Run read-only query on a reader connection and return all rows."""
+        with self._read() as cur:
+            cur.execute(query, params)
+            return cur.fetchall()
+
+    def execute(self, query, params=()):
+        """Run a writing statement on the writer connection and commit. Returns number of changed rows."""
+        with self._transaction() as cur:
+            cur.execute(query, params)
+            return cur.rowcount
 
 
     def get_unique_sellers(self, subject, table=DEFULT_NAME):
         """Get list of unique seller names for given subject."""
         table = self._table_name(table)
         query = f"SELECT DISTINCT seller_name FROM {table} WHERE subject = ? ORDER BY seller_name ASC"
-        with self.lock:
-            self.cur.execute(query, (subject,))
-            rows = self.cur.fetchall()
+        with self._read() as cur:
+            cur.execute(query, (subject,))
+            rows = cur.fetchall()
         return [row[0] for row in rows if row[0] is not None]
 
-    def query_raw_with_filters(self, subject, date_from=None, date_to=None, price_min=None, price_max=None, only_paid=False, seller_name=None, invoice_type=None, table=DEFULT_NAME):
-        """Return raw invoice rows (dicts) without formatting. Use when caller will format/present data."""
+    def _filtered_query(self, subject, date_from=None, date_to=None, price_min=None, price_max=None, only_paid=False, only_unpaid=False, seller_name=None, invoice_type=None, table=DEFULT_NAME):
+        """Build invoice list query and params for the filters of query_raw_with_filters."""
         table = self._table_name(table)
         query = f"""
-        SELECT ksef, subject, invoice_date, invoice_number, buyer_name, seller_name, type, net_amount, gross_amount, currency, is_paid
+        SELECT {INVOICE_LIST_COLUMNS}
         FROM {table}
         WHERE subject = ?
         """
@@ -199,6 +413,8 @@ class Database:
             params.append(price_max)
         if only_paid:
             query += " AND is_paid = 1"
+        if only_unpaid:
+            query += " AND COALESCE(is_paid, 0) = 0"
         if seller_name:
             query += " AND seller_name = ?"
             params.append(seller_name)
@@ -207,25 +423,54 @@ class Database:
             params.append(invoice_type)
 
         query += " ORDER BY invoice_date ASC"
+        return query, params
 
-        with self.lock:
-            self.cur.execute(query, params)
-            rows = self.cur.fetchall()
-            columns = [d[0] for d in self.cur.description] if self.cur.description else []
-            result = [dict(zip(columns, r)) for r in rows]
-        return result
+    def query_raw_with_filters(self, subject, date_from=None, date_to=None, price_min=None, price_max=None, only_paid=False, seller_name=None, invoice_type=None, table=DEFULT_NAME, only_unpaid=False):
+        """Return raw invoice rows (dicts) without formatting. Use when caller will format/present data."""
+        query, params = self._filtered_query(subject, date_from, date_to, price_min, price_max, only_paid, only_unpaid, seller_name, invoice_type, table)
+        with self._read() as cur:
+            cur.execute(query, params)
+            rows = cur.fetchall()
+            columns = [d[0] for d in cur.description] if cur.description else []
+        return [dict(zip(columns, r)) for r in rows]
+
+    def query_columns_with_filters(self, subject, date_from=None, date_to=None, price_min=None, price_max=None, only_paid=False, only_unpaid=False, seller_name=None, invoice_type=None, table=DEFULT_NAME):
+        """Return invoices matching the filters as columns: dict of column name -> list of values.
+
+        Rows are read in chunks of FETCH_ROWS and appended column by column, so no per-row
+        objects are kept; suited for building a DataFrame (see invoice.dataframe).
+        """
+        query, params = self._filtered_query(subject, date_from, date_to, price_min, price_max, only_paid, only_unpaid, seller_name, invoice_type, table)
+        with self._read() as cur:
+            cur.execute(query, params)
+            names = [d[0] for d in cur.description]
+            columns = [[] for _ in names]
+            while True:
+                rows = cur.fetchmany(FETCH_ROWS)
+                if not rows:
+                    break
+                for column, values in zip(columns, zip(*rows)):
+                    column.extend(values)
+        return dict(zip(names, columns))
 
     def update_paid_status(self, ksef_number, subject, is_paid, table=DEFULT_NAME):
         """Update the is_paid status for a given invoice."""
-        table = self._table_name(table)
-        query = f"UPDATE {table} SET is_paid = ? WHERE ksef = ? AND subject = ?;"
         try:
-            with self.lock:
-                self.cur.execute(query, (is_paid, ksef_number, subject))
-                self.con.commit()
+            self.set_paid_bulk([(ksef_number, subject)], is_paid, table=table)
             return True
         except Exception as e:
             print(f"Error updating paid status for {ksef_number}: {e}")
             return False
 
+    def set_paid_bulk(self, keys, is_paid, table=DEFULT_NAME):
+        """Set is_paid for all invoices given as (ksef_number, subject) pairs in one transaction.
+
+        Returns number of updated rows. Raises on error, in which case no row is changed.
+        """
+        table = self._table_name(table)
+        query = f"UPDATE {table} SET is_paid = ? WHERE ksef = ? AND subject = ?;"
+        with self._transaction() as cur:
+            cur.executemany(query, [(bool(is_paid), ksef, subject) for ksef, subject in keys])
+            return cur.rowcount
+
 
@@ -1,6 +1,6 @@
 from authentication.token import start_session
 from invoice.download import download_metadata, download_invoice
-import requests
+from api.client import get_client
 from db.sqlite import Database
 BASE = "https://api.ksef.mf.gov.pl/v2"
 # BASE = "https://api-test.ksef.mf.gov.pl/v2"
@@ -12,7 +12,7 @@ if __name__ == "__main__":
     session = start_session(BASE, tokenfilename, sessionFilename)
     auth_token = session.get("accessToken")
 
-    invoices, error = download_metadata(BASE, auth_token, subject="Subject3")
+    invoices, error = download_metadata(BASE, auth_token, subject="Subject3", rate_key=session.get("nip"))
 
     if error:
         print(f"Error: {error}")
@@ -22,6 +22,7 @@ if __name__ == "__main__":
     # print("\nInvoices:")
     for invoice in invoices:
         print(invoice.get("ksefNumber"), invoice.get("invoiceNumber"), invoice.get("issueDate"), invoice.get("invoiceType"))
+    print("KSeF HTTP:", get_client(BASE).stats())
 
     #     db.insert_invoice(invoice, subject="Subject3")
     # print(db.fetch("SELECT ksef, type FROM invoices"))
\ No newline at end of file
@@ -0,0 +1,560 @@
+import argparse
+import base64
+import io
+import json
+import random
+import threading
+import time
+import uuid
+import zipfile
+import zlib
+from datetime import datetime, timedelta, timezone
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+from Cryptodome.Cipher import AES, PKCS1_OAEP
+from Cryptodome.Hash import SHA256
+from Cryptodome.PublicKey import RSA
+from Cryptodome.Util.Padding import pad
+from invoice.mock import iter_fake_invoices
+
+# Lokalny zamiennik API KSeF v2 do testów offline, benchmarków i testów obciążeniowych.
+# Uruchomienie: python fake_ksef_server.py --port 8765 --latency 0.05 --rate-limit 8
+# i BASE = "http://127.0.0.1:8765/v2" w skryptach / ksef_multi_browser.py.
+
+API_PREFIX = "/v2"
+DATE_FIELDS = {
+    "Issue": "issueDate",
+    "Invoicing": "invoicingDate",
+    "PermanentStorage": "permanentStorageDate",
+}
+# grupy endpointów, dla których liczony jest limit żądań
+RATE_GROUPS = ["/invoices/query/metadata", "/invoices/ksef", "/invoices/exports", "/auth", "/security", "/storage"]
+FA2_NAMESPACE = "http://crd.gov.pl/wzor/2023/06/29/12648/"
+
+
+class FakeKsefConfig:
+    """Behaviour of the fake server; all values can be changed while it is running."""
+
+    def __init__(self, invoices=500, days=365, seed=1, latency=0.0, jitter=0.0, rate_limit=None,
+                 failure_rate=0.0, auth_pending_polls=1, export_pending_polls=2, truncate_after=10000,
+                 access_ttl=900, refresh_ttl=7 * 24 * 3600, part_size=1024 * 1024, max_page_size=250):
+        self.invoices = invoices                        # faktur na (NIP, subject)
+        self.days = days                                # zakres dat wygenerowanych faktur wstecz od dziś
+        self.seed = seed
+        self.latency = latency                          # s, opóźnienie każdej odpowiedzi
+        self.jitter = jitter                            # s, losowy dodatek do opóźnienia
+        self.rate_limit = rate_limit                    # żądań/s na (grupa endpointów, token) albo {grupa: limit}
+        self.failure_rate = failure_rate                # prawdopodobieństwo odpowiedzi 503
+        self.auth_pending_polls = auth_pending_polls    # ile razy /auth/{ref} zwraca 100 przed 200
+        self.export_pending_polls = export_pending_polls
+        self.truncate_after = truncate_after            # limit wyników jednego zapytania (isTruncated)
+        self.access_ttl = access_ttl                    # s
+        self.refresh_ttl = refresh_ttl                  # s
+        self.part_size = part_size                      # bajtów na część paczki eksportu
+        self.max_page_size = max_page_size
+
+    def limit_for(self, group):
+        if isinstance(self.rate_limit, dict):
+            return self.rate_limit.get(group)
+        return self.rate_limit
+
+
+def _iso(ts: datetime) -> str:
+    return ts.isoformat(timespec="seconds")
+
+def _parse_date(value):
+    if not value:
+        return None
+    ts = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    if ts.tzinfo is None:
+        ts = ts.replace(tzinfo=timezone.utc)
+    return ts
+
+def _compare_date(value):
+    # daty samych dni (issueDate) porównywane jako początek dnia
+    return _parse_date(value if len(value) > 10 else value + "T00:00:00")
+
+
+class FakeKsefState:
+    """Tokens, sessions, generated invoices and exports shared by all handler threads."""
+
+    def __init__(self, config: FakeKsefConfig):
+        self.config = config
+        self.lock = threading.Lock()
+        self.key = RSA.generate(2048)
+        self.decipher = PKCS1_OAEP.new(self.key, hashAlgo=SHA256)
+        self.challenges = {}        # challenge -> timestampMs
+        self.auth_operations = {}   # reference -> {nip, token, polls, redeemed}
+        self.access_tokens = {}     # token -> (nip, valid_until)
+        self.refresh_tokens = {}    # token -> (nip, valid_until)
+        self.datasets = {}          # (nip, subject) -> invoices sorted by permanentStorageDate
+        self.documents = {}         # ksef -> (nip, subject, index)
+        self.exports = {}           # reference -> {polls, package, parts}
+        self.windows = {}           # (group, token) -> (second, count)
+        self.counters = {"requests": 0, "throttled": 0, "failed": 0, "bytes_sent": 0}
+        self.endpoint_counts = {}
+
+    def certificates(self):
+        # KSeF wysyła certyfikat X.509; klucz publiczny w DER jest tak samo czytany przez RSA.import_key
+        public_der = base64.b64encode(self.key.publickey().export_key("DER")).decode("utf-8")
+        now = datetime.now(timezone.utc)
+        return [
+            {"certificate": public_der, "validFrom": _iso(now - timedelta(days=1)),
+             "validTo": _iso(now + timedelta(days=365)), "usage": ["KsefTokenEncryption"]},
+            {"certificate": public_der, "validFrom": _iso(now - timedelta(days=1)),
+             "validTo": _iso(now + timedelta(days=365)), "usage": ["SymmetricKeyEncryption"]},
+        ]
+
+    def issue_token(self, store, nip, ttl):
+        token = uuid.uuid4().hex
+        valid_until = datetime.now(timezone.utc) + timedelta(seconds=ttl)
+        store[token] = (nip, valid_until)
+        return {"token": token, "validUntil": _iso(valid_until)}
+
+    def check_token(self, store, token):
+        """Return NIP for a valid token from `store`, else None."""
+        entry = store.get(token)
+        if not entry or entry[1] <= datetime.now(timezone.utc):
+            return None
+        return entry[0]
+
+    def dataset(self, nip, subject):
+        with self.lock:
+            invoices = self.datasets.get((nip, subject))
+            if invoices is not None:
+                return invoices
+        seed = zlib.crc32(f"{self.config.seed}|{nip}|{subject}".encode())
+        invoices = _generate_dataset(nip, subject, self.config.invoices, self.config.days, seed)
+        with self.lock:
+            invoices = self.datasets.setdefault((nip, subject), invoices)
+            for index, invoice in enumerate(invoices):
+                self.documents.setdefault(invoice["ksefNumber"], (nip, subject, index))
+        return invoices
+
+    def query(self, nip, filters):
+        """Return (matching invoices, is_truncated) for metadata query / export filters."""
+        subject = filters.get("subjectType", "Subject1")
+        date_range = filters.get("dateRange") or {}
+        field = DATE_FIELDS.get(date_range.get("dateType"), "issueDate")
+        from_date = _parse_date(date_range.get("from"))
+        to_date = _parse_date(date_range.get("to"))
+        result = []
+        for invoice in self.dataset(nip, subject):
+            ts = _compare_date(invoice[field])
+            if from_date and ts < from_date: continue
+            if to_date and ts > to_date: continue
+            result.append(invoice)
+        result.sort(key=lambda inv: inv[field])
+        truncated = len(result) > self.config.truncate_after
+        return result[:self.config.truncate_after], truncated
+
+    def document(self, ksef_number):
+        with self.lock:
+            entry = self.documents.get(ksef_number)
+            if not entry:
+                return None
+            nip, subject, index = entry
+            invoice = self.datasets[(nip, subject)][index]
+        return _invoice_xml(invoice)
+
+
+def _generate_dataset(nip, subject, count, days, seed):
+    """Invoices for one (NIP, subject), sorted by permanentStorageDate."""
+    invoices = list(iter_fake_invoices(subject, count, seed=seed, days=days, company_nip=nip))
+    invoices.sort(key=lambda inv: inv["permanentStorageDate"])
+    return invoices
+
+
+def _invoice_xml(invoice) -> bytes:
+    """Minimal FA(2) document matching the metadata, enough for invoice.parser."""
+    net = float(invoice["netAmount"])
+    vat = float(invoice["vatAmount"])
+    gross = float(invoice["grossAmount"])
+    due = (datetime.fromisoformat(invoice["issueDate"]) + timedelta(days=14)).date().isoformat()
+    buyer = invoice.get("buyer") or {}
+    corrected = invoice.get("correctedInvoice")
+    correction = (f"<DaneFaKorygowanej><NrFaKorygowanej>{corrected['invoiceNumber']}</NrFaKorygowanej>"
+                  f"<NrKSeFFaKorygowanej>{corrected['ksefNumber']}</NrKSeFFaKorygowanej></DaneFaKorygowanej>"
+                  if corrected else "")
+    xml = f"""<?xml version="1.0" encoding="UTF-8"?>
+<Faktura xmlns="{FA2_NAMESPACE}">
+  <Naglowek><KodFormularza kodSystemowy="FA (2)" wersjaSchemy="1-0E">FA</KodFormularza><WariantFormularza>2</WariantFormularza></Naglowek>
+  <Podmiot1><DaneIdentyfikacyjne><NIP>{invoice["seller"]["nip"]}</NIP><Nazwa>{invoice["seller"]["name"]}</Nazwa></DaneIdentyfikacyjne></Podmiot1>
+  <Podmiot2><DaneIdentyfikacyjne><NIP>{(buyer.get("identifier") or {}).get("value", "")}</NIP><Nazwa>{buyer.get("name", "")}</Nazwa></DaneIdentyfikacyjne></Podmiot2>
+  <Fa>
+    <KodWaluty>{invoice.get("currency", "PLN")}</KodWaluty>
+    <P_1>{invoice["issueDate"]}</P_1>
+    <P_2>{invoice["invoiceNumber"]}</P_2>
+    <P_13_1>{net:.2f}</P_13_1>
+    <P_14_1>{vat:.2f}</P_14_1>
+    <P_15>{gross:.2f}</P_15>
+    <RodzajFaktury>{invoice.get("invoiceType", "VAT").upper()}</RodzajFaktury>{correction}
+    <FaWiersz><NrWierszaFa>1</NrWierszaFa><P_7>Usługa testowa</P_7><P_8A>szt.</P_8A><P_8B>1</P_8B><P_9A>{net:.2f}</P_9A><P_11>{net:.2f}</P_11><P_12>23</P_12></FaWiersz>
+    <Platnosc><TerminPlatnosci><Termin>{due}</Termin></TerminPlatnosci></Platnosc>
+  </Fa>
+</Faktura>
+"""
+    return xml.encode("utf-8")
+
+
+def _build_package(invoices, key, iv, part_size):
+    """Export package: ZIP with XML + _metadata.json, split into parts encrypted with AES-256-CBC."""
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, "w", zipfile.ZIP_DEFLATED) as zf:
+        for invoice in invoices:
+            zf.writestr(f"{invoice['ksefNumber']}.xml", _invoice_xml(invoice))
+        zf.writestr("_metadata.json", json.dumps({"invoices": invoices}))
+    data = buf.getvalue()
+    return [AES.new(key, AES.MODE_CBC, iv).encrypt(pad(data[i:i + part_size], AES.block_size))
+            for i in range(0, max(len(data), 1), part_size)]
+
+
+class FakeKsefHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1" # keep-alive, jak w prawdziwym API
+    state: FakeKsefState = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self._dispatch("GET")
+
+    def do_POST(self):
+        self._dispatch("POST")
+
+    def _send(self, code, body=None, content_type="application/json", headers=None):
+        if body is None:
+            data = b""
+        elif isinstance(body, bytes):
+            data = body
+        else:
+            data = json.dumps(body).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+        with self.state.lock:
+            self.state.counters["bytes_sent"] += len(data)
+
+    def _error(self, code, description, details=None):
+        self._send(code, {"status": {"code": code, "description": description, "details": details or []}})
+
+    def _bearer(self):
+        header = self.headers.get("Authorization", "")
+        return header[7:] if header.startswith("Bearer ") else None
+
+    def _throttled(self, path, token):
+        """Fixed one-second window per (endpoint group, token). Returns True after sending 429."""
+        group = next((g for g in RATE_GROUPS if path.startswith(g)), path)
+        limit = self.state.config.limit_for(group)
+        if not limit:
+            return False
+        second = int(time.monotonic())
+        with self.state.lock:
+            window, count = self.state.windows.get((group, token), (second, 0))
+            if window != second:
+                window, count = second, 0
+            count += 1
+            self.state.windows[(group, token)] = (window, count)
+            if count <= limit:
+                return False
+            self.state.counters["throttled"] += 1
+        self._send(429, {"status": {
+            "code": 429,
+            "description": "Too Many Requests",
+            "details": [f"Przekroczono limit {limit} żądań na sekundę. Spróbuj ponownie po 1 sekundach."],
+        }}, headers={"Retry-After": "1"})
+        return True
+
+    def _dispatch(self, method):
+        state = self.state
+        config = state.config
+        length = int(self.headers.get("Content-Length") or 0)
+        raw = self.rfile.read(length) if length else b""
+        url = urlparse(self.path)
+        path = url.path[len(API_PREFIX):] if url.path.startswith(API_PREFIX) else url.path
+        query = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        with state.lock:
+            state.counters["requests"] += 1
+            group = next((g for g in RATE_GROUPS if path.startswith(g)), path)
+            state.endpoint_counts[group] = state.endpoint_counts.get(group, 0) + 1
+
+        if config.latency or config.jitter:
+            time.sleep(config.latency + random.uniform(0, config.jitter))
+        if self._throttled(path, self._bearer()):
+            return
+        if config.failure_rate and random.random() < config.failure_rate:
+            with state.lock:
+                state.counters["failed"] += 1
+            return self._error(503, "Service Unavailable", ["Wstrzyknięty błąd serwera testowego"])
+
+        body = {}
+        if method == "POST" and raw:
+            # treść GET (np. auth_check) jest ignorowana, jak w KSeF
+            try:
+                body = json.loads(raw)
+            except ValueError:
+                return self._error(400, "Bad Request", ["Niepoprawny JSON"])
+
+        route = ROUTES.get((method, path))
+        if route is None:
+            for (route_method, prefix), handler in PREFIX_ROUTES.items():
+                if method == route_method and path.startswith(prefix):
+                    route = handler
+                    break
+        if route is None:
+            return self._error(404, "Not Found", [path])
+        route(self, path, query, body)
+
+    # --- uwierzytelnianie ---
+
+    def challenge(self, path, query, body):
+        now = datetime.now(timezone.utc)
+        challenge = f"{now:%Y%m%d}-CR-{uuid.uuid4().hex[:20].upper()}"
+        timestamp_ms = int(now.timestamp() * 1000)
+        with self.state.lock:
+            self.state.challenges[challenge] = timestamp_ms
+        self._send(200, {"challenge": challenge, "timestamp": now.isoformat(), "timestampMs": timestamp_ms})
+
+    def certificates(self, path, query, body):
+        self._send(200, self.state.certificates())
+
+    def ksef_token(self, path, query, body):
+        state = self.state
+        with state.lock:
+            timestamp_ms = state.challenges.pop(body.get("challenge"), None)
+        if timestamp_ms is None:
+            return self._error(400, "Bad Request", ["Nieznany challenge"])
+        try:
+            token_time = state.decipher.decrypt(base64.b64decode(body.get("encryptedToken", ""))).decode("utf-8")
+        except (ValueError, TypeError):
+            return self._error(400, "Bad Request", ["Nie udało się odszyfrować tokena"])
+        token, _, timestamp = token_time.rpartition("|")
+        if not token or timestamp != str(timestamp_ms):
+            return self._error(400, "Bad Request", ["Niepoprawny token lub znacznik czasu"])
+
+        nip = (body.get("contextIdentifier") or {}).get("value")
+        reference = f"{datetime.now(timezone.utc):%Y%m%d}-AU-{uuid.uuid4().hex[:20].upper()}"
+        auth_token = uuid.uuid4().hex
+        with state.lock:
+            state.auth_operations[reference] = {"nip": nip, "token": auth_token, "polls": 0, "redeemed": False}
+        valid_until = _iso(datetime.now(timezone.utc) + timedelta(minutes=15))
+        self._send(202, {"referenceNumber": reference, "authenticationToken": {"token": auth_token, "validUntil": valid_until}})
+
+    def auth_status(self, path, query, body):
+        reference = path.rsplit("/", 1)[-1]
+        with self.state.lock:
+            operation = self.state.auth_operations.get(reference)
+            if not operation or operation["token"] != self._bearer():
+                operation = None
+            else:
+                operation["polls"] += 1
+                polls = operation["polls"]
+        if operation is None:
+            return self._error(401, "Unauthorized")
+        if polls <= self.state.config.auth_pending_polls:
+            return self._send(200, {"status": {"code": 100, "description": "Uwierzytelnianie w toku"}})
+        self._send(200, {"status": {"code": 200, "description": "Uwierzytelnianie zakończone sukcesem"}})
+
+    def redeem(self, path, query, body):
+        state = self.state
+        token = self._bearer()
+        with state.lock:
+            operation = next((op for op in state.auth_operations.values() if op["token"] == token), None)
+            ready = operation and not operation["redeemed"] and operation["polls"] > state.config.auth_pending_polls
+            if ready:
+                operation["redeemed"] = True
+                access = state.issue_token(state.access_tokens, operation["nip"], state.config.access_ttl)
+                refresh = state.issue_token(state.refresh_tokens, operation["nip"], state.config.refresh_ttl)
+        if not ready:
+            return self._error(400, "Bad Request", ["Token uwierzytelniający nie może zostać wykorzystany"])
+        self._send(200, {"accessToken": access, "refreshToken": refresh})
+
+    def refresh(self, path, query, body):
+        state = self.state
+        with state.lock:
+            nip = state.check_token(state.refresh_tokens, self._bearer())
+            if nip:
+                access = state.issue_token(state.access_tokens, nip, state.config.access_ttl)
+        if not nip:
+            return self._error(401, "Unauthorized", ["Refresh token nieważny"])
+        self._send(200, {"accessToken": access})
+
+    # --- faktury ---
+
+    def _nip(self):
+        with self.state.lock:
+            nip = self.state.check_token(self.state.access_tokens, self._bearer())
+        if not nip:
+            self._error(401, "Unauthorized", ["Access token nieważny"])
+        return nip
+
+    def metadata(self, path, query, body):
+        nip = self._nip()
+        if not nip:
+            return
+        try:
+            page = int(query.get("pageOffset", 0))
+            page_size = int(query.get("pageSize", 10))
+        except ValueError:
+            return self._error(400, "Bad Request", ["Niepoprawne stronicowanie"])
+        if not 10 <= page_size <= self.state.config.max_page_size:
+            return self._error(400, "Bad Request", [f"pageSize musi być w zakresie 10-{self.state.config.max_page_size}"])
+        invoices, truncated = self.state.query(nip, body)
+        if query.get("sortOrder") == "Desc":
+            invoices = invoices[::-1]
+        start = page * page_size
+        chunk = invoices[start:start + page_size]
+        has_more = start + page_size < len(invoices)
+        self._send(200, {"hasMore": has_more, "isTruncated": truncated and not has_more, "invoices": chunk})
+
+    def invoice(self, path, query, body):
+        if not self._nip():
+            return
+        document = self.state.document(path.rsplit("/", 1)[-1])
+        if document is None:
+            return self._error(404, "Not Found", ["Nie znaleziono faktury"])
+        self._send(200, document, content_type="application/xml")
+
+    # --- eksport ---
+
+    def start_export(self, path, query, body):
+        state = self.state
+        nip = self._nip()
+        if not nip:
+            return
+        encryption = body.get("encryption") or {}
+        try:
+            key = state.decipher.decrypt(base64.b64decode(encryption.get("encryptedSymmetricKey", "")))
+            iv = base64.b64decode(encryption.get("initializationVector", ""))
+        except (ValueError, TypeError):
+            return self._error(400, "Bad Request", ["Nie udało się odszyfrować klucza"])
+        if len(key) != 32 or len(iv) != 16:
+            return self._error(400, "Bad Request", ["Niepoprawny klucz lub wektor inicjujący"])
+
+        invoices, truncated = state.query(nip, body.get("filters") or {})
+        parts = _build_package(invoices, key, iv, state.config.part_size)
+        reference = f"{datetime.now(timezone.utc):%Y%m%d}-EX-{uuid.uuid4().hex[:20].upper()}"
+        last = invoices[-1]["permanentStorageDate"] if invoices else None
+        with state.lock:
+            state.exports[reference] = {"polls": 0, "parts": parts, "invoiceCount": len(invoices),
+                                        "isTruncated": truncated, "lastPermanentStorageDate": last}
+        self._send(202, {"referenceNumber": reference})
+
+    def export_status(self, path, query, body):
+        if not self._nip():
+            return
+        reference = path.rsplit("/", 1)[-1]
+        with self.state.lock:
+            export = self.state.exports.get(reference)
+            if export:
+                export["polls"] += 1
+        if not export:
+            return self._error(404, "Not Found", ["Nie znaleziono eksportu"])
+        if export["polls"] <= self.state.config.export_pending_polls:
+            return self._send(200, {"status": {"code": 100, "description": "Eksport w toku"}})
+
+        host = self.headers.get("Host")
+        parts = [{
+            "ordinalNumber": i + 1,
+            "partName": f"{reference}.zip.{i + 1:03d}.aes",
+            "method": "GET",
+            "url": f"http://{host}/storage/{reference}/{i}",
+            "encryptedPartSize": len(part),
+        } for i, part in enumerate(export["parts"])]
+        self._send(200, {
+            "status": {"code": 200, "description": "Eksport zakończony sukcesem"},
+            "package": {
+                "invoiceCount": export["invoiceCount"],
+                "parts": parts,
+                "isTruncated": export["isTruncated"],
+                "lastPermanentStorageDate": export["lastPermanentStorageDate"],
+            },
+        })
+
+    def export_part(self, path, query, body):
+        # pre-signed URL: bez nagłówka Authorization, jak w KSeF
+        _, _, reference, index = path.split("/")
+        with self.state.lock:
+            export = self.state.exports.get(reference)
+        if not export or not index.isdigit() or int(index) >= len(export["parts"]):
+            return self._error(404, "Not Found")
+        self._send(200, export["parts"][int(index)], content_type="application/octet-stream")
+
+
+ROUTES = {
+    ("POST", "/auth/challenge"): FakeKsefHandler.challenge,
+    ("GET", "/security/public-key-certificates"): FakeKsefHandler.certificates,
+    ("POST", "/auth/ksef-token"): FakeKsefHandler.ksef_token,
+    ("POST", "/auth/token/redeem"): FakeKsefHandler.redeem,
+    ("POST", "/auth/token/refresh"): FakeKsefHandler.refresh,
+    ("POST", "/invoices/query/metadata"): FakeKsefHandler.metadata,
+    ("POST", "/invoices/exports"): FakeKsefHandler.start_export,
+}
+PREFIX_ROUTES = {
+    ("GET", "/auth/"): FakeKsefHandler.auth_status,
+    ("GET", "/invoices/ksef/"): FakeKsefHandler.invoice,
+    ("GET", "/invoices/exports/"): FakeKsefHandler.export_status,
+    ("GET", "/storage/"): FakeKsefHandler.export_part,
+}
+
+
+class FakeKsefServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, config: FakeKsefConfig):
+        self.state = FakeKsefState(config)
+        handler = type("BoundFakeKsefHandler", (FakeKsefHandler,), {"state": self.state})
+        super().__init__(address, handler)
+
+    @property
+    def base_url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}{API_PREFIX}"
+
+    @property
+    def config(self):
+        return self.state.config
+
+    def stats(self) -> dict:
+        with self.state.lock:
+            return dict(self.state.counters, endpoints=dict(self.state.endpoint_counts))
+
+
+def start_fake_server(config: FakeKsefConfig | None = None, host="127.0.0.1", port=0):
+    """Start the fake server in a background thread. Returns the server; use `server.base_url` as BASE."""
+    server = FakeKsefServer((host, port), config or FakeKsefConfig())
+    threading.Thread(target=server.serve_forever, name="fake-ksef", daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Lokalny serwer udający API KSeF v2")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--invoices", type=int, default=500, help="faktur na (NIP, subject)")
+    parser.add_argument("--days", type=int, default=365)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--latency", type=float, default=0.0, help="opóźnienie odpowiedzi w s")
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--rate-limit", type=int, default=None, help="żądań/s na grupę endpointów i token")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="udział odpowiedzi 503")
+    parser.add_argument("--truncate-after", type=int, default=10000)
+    args = parser.parse_args()
+
+    config = FakeKsefConfig(
+        invoices=args.invoices, days=args.days, seed=args.seed, latency=args.latency, jitter=args.jitter,
+        rate_limit=args.rate_limit, failure_rate=args.failure_rate, truncate_after=args.truncate_after,
+    )
+    server = FakeKsefServer((args.host, args.port), config)
+    print(f"Fake KSeF: {server.base_url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(server.stats())
@@ -0,0 +1,96 @@
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from invoice.download import download_invoice, download_invoice_to_store, invoice_path
+
+DEFAULT_WORKERS = 6
+MANIFEST_NAME = "manifest.json"
+MANIFEST_SAVE_INTERVAL = 1.0 # s
+
+
+def download_many(BASE, auth_token, ksef_numbers, path, max_workers=DEFAULT_WORKERS, progress=None, manifest_file=None, store=None, rate_key=None):
+    """Download many invoices in parallel into `path`, or into DocumentStore `store` if given.
+
+    Invoices already present in `path` (or in `store`) are skipped. The batch is recorded in a manifest
+    (`path/manifest.json` by default, use one per company); invoices left unfinished by an
+    interrupted batch are added to the next call, so it continues where the previous one stopped.
+    `progress(done, total)` is called from the calling thread after each invoice.
+    `rate_key` (the company NIP) is passed to the rate limiter of the invoice requests.
+    Returns (downloaded, skipped, failed) where failed is a list of KSeF numbers.
+    """
+    os.makedirs(path, exist_ok=True)
+    manifest_file = manifest_file or os.path.join(path, MANIFEST_NAME)
+    manifest = _load_manifest(manifest_file)
+
+    # resume unfinished invoices from interrupted batch, keep order and drop duplicates
+    batch = list(dict.fromkeys(manifest.get("pending", []) + [str(k) for k in ksef_numbers if k]))
+    if store is not None:
+        local = store.get_hashes(batch)
+        pending = []
+        for k in batch:
+            if k in local:
+                continue
+            # files downloaded before the document store existed are imported, not fetched again
+            if os.path.exists(invoice_path(path, k)):
+                store.put_file(k, invoice_path(path, k))
+                continue
+            pending.append(k)
+    else:
+        pending = [k for k in batch if not os.path.exists(invoice_path(path, k))]
+    skipped = len(batch) - len(pending)
+    total = len(batch)
+
+    manifest = {"pending": list(pending)}
+    _save_manifest(manifest_file, manifest)
+
+    downloaded = 0
+    failed = []
+    done = skipped
+    if progress: progress(done, total)
+    last_save = time.monotonic()
+    with ThreadPoolExecutor(max_workers=max(max_workers, 1)) as pool:
+        if store is not None:
+            futures = {pool.submit(download_invoice_to_store, BASE, auth_token, k, store, rate_key): k for k in pending}
+        else:
+            futures = {pool.submit(download_invoice, BASE, auth_token, k, path, rate_key): k for k in pending}
+        for future in as_completed(futures):
+            ksef_number = futures[future]
+            try:
+                saved = future.result()
+            except Exception as e:
+                print(f"Błąd pobierania faktury {ksef_number}: {e}")
+                saved = None
+            if saved:
+                downloaded += 1
+            else:
+                failed.append(ksef_number)
+            manifest["pending"].remove(ksef_number)
+            done += 1
+            if progress: progress(done, total)
+            if time.monotonic() - last_save >= MANIFEST_SAVE_INTERVAL:
+                _save_manifest(manifest_file, manifest)
+                last_save = time.monotonic()
+
+    # failed invoices stay pending for the next batch
+    if failed:
+        _save_manifest(manifest_file, {"pending": failed})
+    elif os.path.exists(manifest_file):
+        os.remove(manifest_file)
+    return downloaded, skipped, failed
+
+
+def _load_manifest(manifest_file):
+    if not os.path.exists(manifest_file):
+        return {}
+    try:
+        with open(manifest_file, "r") as f:
+            return json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return {}
+
+def _save_manifest(manifest_file, manifest):
+    tmp_file = manifest_file + ".tmp"
+    with open(tmp_file, "w") as f:
+        json.dump(manifest, f)
+    os.replace(tmp_file, manifest_file)
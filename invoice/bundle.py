@@ -0,0 +1,35 @@
+import os
+import shutil
+import zipfile
+from invoice.download import CHUNK_SIZE, invoice_path
+
+
+def build_zip(ksef_numbers, path, zip_path, store=None):
+    """Pack downloaded invoices from `path` (or DocumentStore `store`) into ZIP archive `zip_path`.
+
+    Files are copied into the archive in chunks and the archive is written to disk,
+    so memory use does not depend on the number or size of invoices.
+    Returns (zip_path, missing) where missing lists invoices not found.
+    """
+    folder = os.path.dirname(zip_path)
+    if folder:
+        os.makedirs(folder, exist_ok=True)
+
+    missing = []
+    tmp_path = zip_path + ".part"
+    with zipfile.ZipFile(tmp_path, "w", compression=zipfile.ZIP_DEFLATED) as zf:
+        local = store.get_hashes(ksef_numbers) if store is not None else {}
+        for ksef_number in dict.fromkeys(ksef_numbers):
+            file_path = invoice_path(path, ksef_number)
+            if ksef_number in local:
+                with zf.open(os.path.basename(file_path), "w") as dst:
+                    for chunk in store.iter_chunks(ksef_number):
+                        dst.write(chunk)
+                continue
+            if not os.path.exists(file_path):
+                missing.append(ksef_number)
+                continue
+            with open(file_path, "rb") as src, zf.open(os.path.basename(file_path), "w") as dst:
+                shutil.copyfileobj(src, dst, CHUNK_SIZE)
+    os.replace(tmp_path, zip_path)
+    return zip_path, missing
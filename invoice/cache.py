@@ -0,0 +1,102 @@
+import threading
+from collections import OrderedDict
+from invoice.download import download_invoice_to_store
+
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024 # limit pamięci podręcznej w RAM
+
+
+class InvoiceCache:
+    """Read-through cache for invoice XML: memory LRU -> DocumentStore -> KSeF.
+
+    Invoices never change once they have a KSeF number, so the document store is never
+    invalidated and the network is used only for invoices that were never downloaded.
+    The in-memory tier is bounded by `max_bytes` and evicts least recently used documents.
+    """
+
+    def __init__(self, BASE, store, max_bytes=DEFAULT_MAX_BYTES):
+        self.BASE = BASE
+        self.store = store
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+        self.fetch_locks = {} # ksef -> [lock, holders and waiters], so one invoice is downloaded once even if requested concurrently
+        self.hits = 0
+        self.store_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, auth_token, ksef_number, rate_key=None) -> bytes | None:
+        """Return invoice XML, downloading it only if it is not stored locally. None on download error.
+
+        `rate_key` (the company NIP) is passed to the rate limiter of the download.
+        """
+        content = self._get_memory(ksef_number)
+        if content is not None:
+            return content
+
+        entry = self._enter_fetch(ksef_number)
+        try:
+            with entry[0]:
+                content = self._get_memory(ksef_number)
+                if content is not None:
+                    return content
+                content = self.store.get(ksef_number)
+                if content is not None:
+                    with self.lock:
+                        self.store_hits += 1
+                else:
+                    with self.lock:
+                        self.misses += 1
+                    if not download_invoice_to_store(self.BASE, auth_token, ksef_number, self.store, rate_key):
+                        return None
+                    content = self.store.get(ksef_number)
+                self._put_memory(ksef_number, content)
+            return content
+        finally:
+            self._leave_fetch(ksef_number, entry)
+
+    def _enter_fetch(self, ksef_number):
+        with self.lock:
+            entry = self.fetch_locks.setdefault(ksef_number, [threading.Lock(), 0])
+            entry[1] += 1
+            return entry
+
+    def _leave_fetch(self, ksef_number, entry):
+        # the last holder or waiter removes the entry, so nobody gets a second lock for the same invoice
+        with self.lock:
+            entry[1] -= 1
+            if entry[1] == 0 and self.fetch_locks.get(ksef_number) is entry:
+                del self.fetch_locks[ksef_number]
+
+    def _get_memory(self, ksef_number):
+        with self.lock:
+            content = self.entries.get(ksef_number)
+            if content is not None:
+                self.entries.move_to_end(ksef_number)
+                self.hits += 1
+            return content
+
+    def _put_memory(self, ksef_number, content):
+        if content is None or len(content) > self.max_bytes:
+            return
+        with self.lock:
+            if ksef_number in self.entries:
+                return
+            self.entries[ksef_number] = content
+            self.size += len(content)
+            while self.size > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+                self.evictions += 1
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "store_hits": self.store_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self.entries),
+                "bytes": self.size,
+            }
@@ -0,0 +1,77 @@
+import numpy as np
+import pandas as pd
+
+# Display names for invoice types
+INVOICE_TYPE_DISPLAY = {
+    "Vat": "Vat",
+    "Kor": "Korygująca",
+    "Roz": "Rozliczeniowa",
+    "Zal": "Zaliczkowa",
+    "Upr": "Upr",
+    "Wszystkie": "Wszystkie"
+}
+
+def format_invoice_type_display(val):
+    return INVOICE_TYPE_DISPLAY.get(val, val)
+
+
+# Display names of invoice list columns
+COLUMN_NAMES = {
+    "ksef": "KSeF",
+    "subject": "Podmiot",
+    "invoice_number": "Numer Faktury",
+    "invoice_date": "Data Wystawienia",
+    "buyer_name": "Nabywca",
+    "buyer_id": "NIP Nabywcy",
+    "seller_name": "Sprzedawca",
+    "seller_nip": "NIP Sprzedawcy",
+    "net_amount": "Kwota Netto",
+    "gross_amount": "Kwota Brutto",
+    "vat_amount": "Kwota VAT",
+    "is_paid": "Opłacona",
+    "type": "Typ",
+    "currency": "Waluta",
+    "doc_hash": "Hash XML",
+}
+AMOUNT_COLUMNS = ["net_amount", "gross_amount", "vat_amount"]
+
+
+def _typed_column(name, values):
+    """Convert list of values of column `name` to a numpy/pandas array of its dtype."""
+    if name == "invoice_date":
+        try:
+            return np.array(values, dtype="datetime64[D]")
+        except ValueError:
+            return pd.to_datetime(values, format="ISO8601", errors="coerce")
+    if name in AMOUNT_COLUMNS:
+        # DECIMAL(16, 2) columns are stored by SQLite as REAL
+        return np.array(values, dtype="float64")
+    if name == "is_paid":
+        return np.array(values, dtype=bool)
+    if name == "type":
+        # few distinct values, display names are mapped once per category
+        return pd.Categorical(np.array(values, dtype=object)).rename_categories(format_invoice_type_display)
+    # object array skips pandas' dtype inference
+    return np.array(values, dtype=object)
+
+
+def get_invoices_df(db, subject, date_from=None, date_to=None, price_min=None, price_max=None, only_paid=False, only_unpaid=False, seller_name=None, invoice_type=None, table=None):
+    """Fetch invoices from DB into a typed DataFrame with display column names (COLUMN_NAMES).
+
+    The frame is built column by column from Database.query_columns_with_filters: dates are
+    datetime64, amounts float64, paid status bool and invoice type categorical with display
+    names. Formatting is left to the view.
+    """
+    columns = db.query_columns_with_filters(
+        subject,
+        date_from=date_from,
+        date_to=date_to,
+        price_min=price_min,
+        price_max=price_max,
+        only_paid=only_paid,
+        only_unpaid=only_unpaid,
+        seller_name=seller_name,
+        invoice_type=invoice_type,
+        table=table
+    )
+    return pd.DataFrame({COLUMN_NAMES.get(name, name): _typed_column(name, values) for name, values in columns.items()})
@@ -1,48 +1,132 @@
-import requests
 import os
-def download_metadata(BASE, auth_token, subject="Subject1", from_date="2026-01-01T00:00:00", to_date="2026-03-01T00:00:00"):
+from api.client import get_client
+
+PAGE_SIZE = 250 # maksymalny rozmiar strony w KSeF
+CHUNK_SIZE = 64 * 1024 # rozmiar bloku przy zapisie pobieranych plików
+
+# pole metadanych odpowiadające typowi daty w zapytaniu
+DATE_FIELDS = {
+    "Issue": "issueDate",
+    "Invoicing": "invoicingDate",
+    "PermanentStorage": "permanentStorageDate",
+}
+
+def iter_metadata_pages(BASE, auth_token, subject="Subject1", from_date="2026-01-01T00:00:00", to_date="2026-03-01T00:00:00", date_type="Issue", page_size=PAGE_SIZE, rate_key=None):
+    """Yield (invoices, error) for every page of metadata as it arrives.
+
+    Pages are requested one by one, so only a single page is held in memory.
+    When KSeF truncates the result set, the query continues from the date of the last invoice.
+    On error yields (None, error) and stops.
+    `rate_key` (the company NIP) keeps rate limits of the company across token refreshes.
+    """
     headers = {
         "Content-Type": "application/json",
-        "Authorization": "Bearer "+str(auth_token),
     }
     body = {
         "subjectType": subject,
         "dateRange": {
-            "dateType": "Issue",
+            "dateType": date_type,
             "from": from_date,
             "to": to_date
         },
     }
-    meta_list = requests.post(
-        BASE+"/invoices/query/metadata",    
+    client = get_client(BASE)
+    page = 0
+    while True:
+        meta_list = client.post(
+            "/invoices/query/metadata",
+            auth_token=auth_token,
+            headers=headers,
+            params={"pageOffset": page, "pageSize": page_size, "sortOrder": "Asc"},
+            json=body,
+            rate_key=rate_key,
+        )
+        # print("\nMetadata:")
+        # print("Status code:",meta_list.status_code)
+        if meta_list.status_code == 429:
+            print(meta_list.text)
+            yield None, meta_list.json().get("status").get("details")[0]
+            return
+        elif meta_list.status_code != 200:
+            print(meta_list.text)
+            yield None, f"Błąd pobierania metadanych: {meta_list.status_code}"
+            return
+
+        data = meta_list.json()
+        invoices = data.get("invoices") or []
+        yield invoices, None
+
+        if data.get("isTruncated") and invoices:
+            # limit wyników osiągnięty - zawęź zakres dat od ostatniej faktury
+            last_date = invoices[-1].get(DATE_FIELDS.get(date_type, "issueDate"))
+            if last_date and len(last_date) == 10:
+                last_date += "T00:00:00"
+            if not last_date or last_date == body["dateRange"]["from"]:
+                yield None, "Błąd pobierania metadanych: zbyt wiele faktur w jednym dniu"
+                return
+            body["dateRange"]["from"] = last_date
+            page = 0
+            continue
+        if not data.get("hasMore"):
+            return
+        page += 1
+
+def download_metadata(BASE, auth_token, subject="Subject1", from_date="2026-01-01T00:00:00", to_date="2026-03-01T00:00:00", date_type="Issue", rate_key=None):
+    """Download all pages of metadata into one list. Prefer iter_metadata_pages for large ranges."""
+    invoices = []
+    for page, error in iter_metadata_pages(BASE, auth_token, subject, from_date, to_date, date_type, rate_key=rate_key):
+        if error:
+            return None, error
+        invoices.extend(page)
+    return invoices, None
+
+def invoice_path(path, ksef_number):
+    return os.path.join(path, f"invoice_{ksef_number}.xml")
+
+def download_invoice(BASE, auth_token, ksef_number, path="invoices", rate_key=None):
+    """Download invoice XML into `path` in chunks. Returns saved file path or None on error."""
+    headers = {
+        "Content-Type": "application/json",
+    }
+
+    invoice = get_client(BASE).get(
+        "/invoices/ksef/"+str(ksef_number),
+        auth_token=auth_token,
         headers=headers,
-        json=body
+        stream=True,
+        rate_key=rate_key,
     )
-    # print("\nMetadata:")
-    # print("Status code:",meta_list.status_code)
-    if meta_list.status_code == 429:
-        print(meta_list.text)
-        return None, meta_list.json().get("status").get("details")[0]
-    elif meta_list.status_code != 200:
-        print(meta_list.text)
-        return None, f"Błąd pobierania metadanych: {meta_list.status_code}"
-    return meta_list.json().get("invoices"), None
-
-def download_invoice(BASE, auth_token, ksef_number, path="invoices"):
+
+    with invoice:
+        if invoice.status_code != 200:
+            print(invoice.text)
+            return None
+
+        save_path = invoice_path(path, ksef_number)
+        # write to temp file first - an interrupted download never leaves a partial invoice
+        tmp_path = save_path + ".part"
+        with open(tmp_path, "wb") as f:
+            for chunk in invoice.iter_content(chunk_size=CHUNK_SIZE):
+                f.write(chunk)
+    os.replace(tmp_path, save_path)
+    return save_path
+
+def download_invoice_to_store(BASE, auth_token, ksef_number, store, rate_key=None):
+    """Download invoice XML straight into DocumentStore `store`. Returns content hash or None on error."""
     headers = {
         "Content-Type": "application/json",
-        "Authorization": "Bearer "+str(auth_token),
     }
 
-    invoice = requests.get(
-        BASE+"/invoices/ksef/"+str(ksef_number),
+    invoice = get_client(BASE).get(
+        "/invoices/ksef/"+str(ksef_number),
+        auth_token=auth_token,
         headers=headers,
+        stream=True,
+        rate_key=rate_key,
     )
 
-    if invoice.status_code != 200:
-        print(invoice.text)
-        return
-    
-    save_path = os.path.join(path, f"invoice_{ksef_number}.xml") 
-    with open(save_path, "wb") as f:
-        f.write(invoice.content)
\ No newline at end of file
+    with invoice:
+        if invoice.status_code != 200:
+            print(invoice.text)
+            return None
+        return store.put_stream(ksef_number, invoice.iter_content(chunk_size=CHUNK_SIZE))
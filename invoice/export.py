@@ -0,0 +1,259 @@
+import base64
+import io
+import json
+import os
+import tempfile
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from itertools import islice
+from Cryptodome.Cipher import AES
+from Cryptodome.Random import get_random_bytes
+from Cryptodome.Util.Padding import unpad
+from api.client import get_client
+from authentication import certificate
+from invoice.download import CHUNK_SIZE
+
+PART_WORKERS = 4            # równoległe pobieranie części paczki
+POLL_INITIAL_DELAY = 1.0    # s, potem x2
+POLL_MAX_DELAY = 30.0
+EXPORT_DEADLINE = 30 * 60   # maksymalny czas oczekiwania na przygotowanie paczki (s)
+METADATA_FILE = "_metadata.json"
+METADATA_BATCH = 5000       # faktur z metadanych zapisywanych w jednej transakcji
+
+
+def start_export(BASE, auth_token, subject, from_date, to_date, date_type="PermanentStorage", rate_key=None):
+    """Request asynchronous invoice export. Returns (reference_number, key, iv)."""
+    key = get_random_bytes(32)
+    iv = get_random_bytes(16)
+    cipher = certificate.get_cipher(BASE, certificate.SYMMETRIC_KEY_ENCRYPTION)
+    body = {
+        "encryption": {
+            "encryptedSymmetricKey": base64.b64encode(cipher.encrypt(key)).decode("utf-8"),
+            "initializationVector": base64.b64encode(iv).decode("utf-8"),
+        },
+        "filters": {
+            "subjectType": subject,
+            "dateRange": {
+                "dateType": date_type,
+                "from": from_date,
+                "to": to_date,
+            },
+        },
+    }
+    resp = get_client(BASE).post(
+        "/invoices/exports",
+        auth_token=auth_token,
+        headers={"Content-Type": "application/json"},
+        json=body,
+        rate_key=rate_key,
+    )
+    if resp.status_code not in (200, 201, 202):
+        print(resp.text)
+        raise Exception(f"Błąd rozpoczęcia eksportu: {resp.status_code}")
+    return resp.json().get("referenceNumber"), key, iv
+
+
+def wait_for_export(BASE, auth_token, reference, deadline=EXPORT_DEADLINE, rate_key=None):
+    """Poll export status with exponential backoff. Returns the `package` description."""
+    client = get_client(BASE)
+    timeout_at = time.monotonic() + deadline
+    delay = POLL_INITIAL_DELAY
+    while True:
+        resp = client.get(f"/invoices/exports/{reference}", auth_token=auth_token, rate_key=rate_key)
+        if resp.status_code != 200:
+            print(resp.text)
+            raise Exception(f"Błąd sprawdzania statusu eksportu: {resp.status_code}")
+        data = resp.json()
+        status = data.get("status") or {}
+        if status.get("code") == 200:
+            return data.get("package") or {}
+        if status.get("code") != 100:
+            raise Exception(f"Eksport nieudany: {status.get('description')} {status.get('details') or ''}")
+        if time.monotonic() + delay > timeout_at:
+            raise Exception(f"Przekroczono czas oczekiwania na eksport ({deadline}s)")
+        time.sleep(delay)
+        delay = min(delay * 2, POLL_MAX_DELAY)
+
+
+def _download_part(BASE, part, key, iv, out_path):
+    """Download one encrypted part and decrypt it (AES-256-CBC, PKCS#7) into `out_path` while streaming."""
+    resp = get_client(BASE).request(part.get("method", "GET"), part["url"], stream=True)
+    with resp:
+        if resp.status_code != 200:
+            raise Exception(f"Błąd pobierania części {part.get('ordinalNumber')}: {resp.status_code}")
+        cipher = AES.new(key, AES.MODE_CBC, iv)
+        pending = b""
+        with open(out_path, "wb") as out:
+            for chunk in resp.iter_content(chunk_size=CHUNK_SIZE):
+                pending += chunk
+                # keep the last block back - it carries the padding
+                ready = (len(pending) - 1) // AES.block_size * AES.block_size
+                if ready > 0:
+                    out.write(cipher.decrypt(pending[:ready]))
+                    pending = pending[ready:]
+            out.write(unpad(cipher.decrypt(pending), AES.block_size))
+    return out_path
+
+
+def download_package(BASE, package, key, iv, zip_path, workers=PART_WORKERS):
+    """Download all parts in parallel, decrypt them and join into ZIP file `zip_path`."""
+    parts = sorted(package.get("parts") or [], key=lambda p: p.get("ordinalNumber", 0))
+    part_paths = [f"{zip_path}.{i}" for i in range(len(parts))]
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as pool:
+        list(pool.map(lambda args: _download_part(BASE, args[0], key, iv, args[1]), zip(parts, part_paths)))
+
+    with open(zip_path, "wb") as out:
+        for part_path in part_paths:
+            with open(part_path, "rb") as f:
+                while True:
+                    chunk = f.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    out.write(chunk)
+            os.remove(part_path)
+    return zip_path
+
+
+def iter_metadata(f):
+    """Yield invoices from a binary `_metadata.json` stream ({"invoices": [...]} or a list) one at a time.
+
+    The file is decoded incrementally, so only the current invoice and one read chunk are in memory.
+    """
+    reader = io.TextIOWrapper(f, encoding="utf-8")
+    decoder = json.JSONDecoder()
+    buf = ""
+    pos = 0
+    eof = False
+
+    def fill():
+        nonlocal buf, pos, eof
+        chunk = reader.read(CHUNK_SIZE)
+        buf = buf[pos:] + chunk
+        pos = 0
+        eof = not chunk
+        return not eof
+
+    def peek():
+        # next non-whitespace character, "" at end of file
+        nonlocal pos
+        while True:
+            while pos < len(buf) and buf[pos].isspace():
+                pos += 1
+            if pos < len(buf):
+                return buf[pos]
+            if not fill():
+                return ""
+
+    def expect(char):
+        nonlocal pos
+        if peek() != char:
+            raise ValueError(f"Niepoprawny plik metadanych: oczekiwano '{char}'")
+        pos += 1
+
+    def value():
+        nonlocal pos
+        peek()
+        while True:
+            try:
+                result, end = decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                if not fill():
+                    raise
+                continue
+            # a number at the end of the buffer may continue in the next chunk
+            if end == len(buf) and fill():
+                continue
+            pos = end
+            return result
+
+    def items():
+        nonlocal pos
+        expect("[")
+        while True:
+            char = peek()
+            if char == "]":
+                pos += 1
+                return
+            if char == ",":
+                pos += 1
+                continue
+            if not char:
+                raise ValueError("Niepoprawny plik metadanych: niekompletna lista faktur")
+            yield value()
+
+    if peek() == "[":
+        yield from items()
+        return
+    expect("{")
+    while True:
+        char = peek()
+        if char == "}" or not char:
+            return
+        if char == ",":
+            pos += 1
+            continue
+        key = value()
+        expect(":")
+        if key == "invoices":
+            yield from items()
+        else:
+            value()
+
+
+def ingest_package(zip_path, db, store, subject, table):
+    """Insert metadata and XML documents from export ZIP. Returns (inserted, stored)."""
+    inserted = 0
+    hashes = {}
+    with zipfile.ZipFile(zip_path) as zf:
+        for info in zf.infolist():
+            name = os.path.basename(info.filename)
+            if name == METADATA_FILE:
+                with zf.open(info) as f:
+                    invoices = iter_metadata(f)
+                    while True:
+                        batch = list(islice(invoices, METADATA_BATCH))
+                        if not batch:
+                            break
+                        inserted += db.upsert_invoices(batch, subject, table=table)
+            elif name.lower().endswith(".xml"):
+                ksef_number = name[:-4]
+                with zf.open(info) as f:
+                    hashes[ksef_number] = store.put_stream(ksef_number, iter(lambda: f.read(CHUNK_SIZE), b""))
+    db.set_document_hashes(hashes, table=table)
+    return inserted, len(hashes)
+
+
+def backfill(BASE, auth_token, db, store, company, subject, from_date, to_date=None, workers=PART_WORKERS, work_dir=None, rate_key=None):
+    """Backfill invoices of one company/subject using KSeF asynchronous export packages.
+
+    Continues with further exports while KSeF reports the package as truncated.
+    With `to_date=None` the range ends now and the sync watermark is moved to the start time.
+    `rate_key` (the company NIP) keeps rate limits of the company across token refreshes.
+    Returns (inserted, stored) counts.
+    """
+    started = datetime.now(timezone.utc).isoformat(timespec="seconds")
+    end = to_date or started
+    inserted = stored = 0
+    since = from_date
+    with tempfile.TemporaryDirectory(dir=work_dir) as tmp:
+        while True:
+            reference, key, iv = start_export(BASE, auth_token, subject, since, end, rate_key=rate_key)
+            print(f"Eksport {reference} ({company}, {subject}) od {since}...")
+            package = wait_for_export(BASE, auth_token, reference, rate_key=rate_key)
+            zip_path = download_package(BASE, package, key, iv, os.path.join(tmp, f"{reference}.zip"), workers)
+            added, docs = ingest_package(zip_path, db, store, subject, company)
+            os.remove(zip_path)
+            inserted += added
+            stored += docs
+            print(f"Eksport {reference}: {package.get('invoiceCount', docs)} faktur, nowych {added}.")
+
+            last = package.get("lastPermanentStorageDate")
+            if not package.get("isTruncated") or not last or last == since:
+                break
+            since = last
+
+    if to_date is None:
+        db.set_sync_watermark(company, subject, started)
+    return inserted, stored
@@ -1,53 +1,193 @@
+import json
+import os
 import random
-from datetime import datetime, timedelta
-import uuid
-
-INVOICE_TYPES = ["Vat", "Zal", "Kor", "Roz", "Upr"]
-SELLERS = [
-    {"name": "Tech Fakers Inc.", "nip": "1234567890"},
-    {"name": "Mock Data Solutions", "nip": "0987654321"},
-    {"name": "Phantom Goods Co.", "nip": "1122334455"},
-    {"name": "TestCorp Ltd.", "nip": "5544332211"},
-]
-BUYERS = [
-    {"name": "Real Client LLC", "identifier": {"value": "9876543210"}},
-    {"name": "Sample Customer", "identifier": {"value": "0123456789"}},
-    {"name": "Generic Buyer", "identifier": {"value": "5432109876"}},
-]
-
-def generate_fake_invoices(subject, num_invoices=50):
-    """Generates a list of fake invoice dictionaries for a given subject."""
-    invoices = []
-    today = datetime.now()
-    for _ in range(num_invoices):
-        invoice_type = random.choice(INVOICE_TYPES)
-        net = round(random.uniform(10, 2000), 2)
-        vat_rate = 0.23
-        
-        # Corrections ('Kor') can have 0 or negative values
+from bisect import bisect
+from collections import deque
+from datetime import datetime, timedelta, time
+from itertools import accumulate, islice
+
+# Rozkłady zbliżone do rzeczywistych danych: większość faktur to zwykłe VAT,
+# nieliczni kontrahenci wystawiają większość faktur, kwoty mają rozkład log-normalny.
+INVOICE_TYPES = ["Vat", "Kor", "Zal", "Roz", "Upr"]
+INVOICE_TYPE_WEIGHTS = [88, 6, 3, 2, 1]
+VAT_RATES = [0.23, 0.08, 0.05, 0.0]
+VAT_RATE_WEIGHTS = [80, 10, 7, 3]
+CURRENCIES = ["PLN", "EUR", "USD"]
+CURRENCY_WEIGHTS = [95, 4, 1]
+NET_MU, NET_SIGMA = 6.5, 1.3    # log-normalny rozkład kwoty netto (mediana ok. 665 zł)
+NET_MAX = 1_000_000
+ZIPF_S = 1.1                    # skośność udziału kontrahentów
+NUM_SELLERS = 500
+NUM_BUYERS = 300
+WEEKEND_WEIGHT = 0.1           # udział faktur w dniu weekendowym względem roboczego
+MONTH_END_WEIGHT = 1.5
+RECENT_ORIGINALS = 5000         # z ilu ostatnich faktur losowane są faktury korygowane
+BATCH_SIZE = 10000
+
+_NAME_PARTS = (
+    ["Tech", "Mock", "Phantom", "Test", "Data", "Polo", "Nova", "Agro", "Bud", "Trans", "Med", "Eko"],
+    ["Fakers", "Solutions", "Goods", "Corp", "Serwis", "System", "Handel", "Logistyka", "Projekt", "Trade"],
+    ["Sp. z o.o.", "S.A.", "Sp. j.", "Inc.", "Ltd.", "s.c."],
+)
+_NIP_WEIGHTS = [6, 5, 7, 2, 3, 4, 5, 6, 7]
+
+
+def _nip(rng):
+    """Random NIP with a valid check digit."""
+    while True:
+        digits = [rng.randint(1, 9)] + [rng.randint(0, 9) for _ in range(8)]
+        check = sum(d * w for d, w in zip(digits, _NIP_WEIGHTS)) % 11
+        if check != 10:
+            return "".join(map(str, digits)) + str(check)
+
+def _companies(rng, count):
+    names = set()
+    companies = []
+    while len(companies) < count:
+        name = " ".join(rng.choice(part) for part in _NAME_PARTS)
+        if name in names:
+            name = f"{name} {len(companies)}"
+        names.add(name)
+        companies.append({"name": name, "nip": _nip(rng)})
+    return companies
+
+def _day_weight(day):
+    # mało faktur w weekendy, więcej na koniec miesiąca
+    if day.weekday() >= 5:
+        return WEEKEND_WEIGHT
+    if (day + timedelta(days=3)).month != day.month:
+        return MONTH_END_WEIGHT
+    return 1.0
+
+def _zipf_weights(count):
+    return list(accumulate(1 / (rank ** ZIPF_S) for rank in range(1, count + 1)))
+
+
+def iter_fake_invoices(subject, count, seed=0, days=365, end=None, company_nip=None, company_name=None):
+    """Lazily yield `count` invoices in KSeF metadata format issued over the last `days`, in issue date order.
+
+    The same `seed` always gives the same invoices (`seed=None` gives different ones each call).
+    With `company_nip` the company is the seller for Subject1 and the buyer for Subject2.
+    `Kor` corrections reference an earlier invoice of the same seller and buyer in `correctedInvoice`.
+    """
+    rng = random.Random(seed)
+    sellers = _companies(rng, NUM_SELLERS)
+    buyers = _companies(rng, NUM_BUYERS)
+    seller_weights = _zipf_weights(NUM_SELLERS)
+    buyer_weights = _zipf_weights(NUM_BUYERS)
+    type_weights = list(accumulate(INVOICE_TYPE_WEIGHTS))
+    rate_weights = list(accumulate(VAT_RATE_WEIGHTS))
+    currency_weights = list(accumulate(CURRENCY_WEIGHTS))
+    if company_nip:
+        company = {"name": company_name or f"Firma {company_nip}", "nip": company_nip}
+        if subject == "Subject1":
+            sellers, seller_weights = [company], [1]
+        elif subject == "Subject2":
+            buyers, buyer_weights = [company], [1]
+
+    end = end or datetime.combine(datetime.now().date(), time())
+    calendar = [(end - timedelta(days=days - k)).date() for k in range(days)]
+    day_weights = list(accumulate(_day_weight(d) for d in calendar))
+    numbers = {}    # (seller nip, prefix, MM/YYYY) -> last invoice number
+    originals = deque(maxlen=RECENT_ORIGINALS)
+    day = None
+
+    for i in range(count):
+        issued = calendar[bisect(day_weights, (i + 0.5) / count * day_weights[-1])]
+        if issued != day:
+            # formatted dates change once per day, not per invoice
+            day = issued
+            issue_date = issued.isoformat()
+            ymd = issued.strftime("%Y%m%d")
+            month = issued.strftime("%m/%Y")
+            morning = datetime.combine(issued, time(8))
+        stored = (morning + timedelta(minutes=rng.randint(0, 36 * 60))).isoformat()
+
+        invoice_type = INVOICE_TYPES[bisect(type_weights, rng.random() * type_weights[-1])]
+        original = None
         if invoice_type == "Kor":
-            if random.random() < 0.5: # 50% chance of being negative
-                net = -net
-            else: # Sometimes a correction is just to zero
-                if random.random() < 0.2:
-                    net = 0
+            if originals:
+                original = originals[rng.randrange(len(originals))]
+            else:
+                invoice_type = "Vat"
 
+        if original:
+            seller = original["seller"]
+            buyer = original["buyer"]
+            currency = original["currency"]
+            vat_rate = original["_vat_rate"]
+            # korekta zmniejszająca część kwoty albo zerująca fakturę
+            net = 0.0 if rng.random() < 0.1 else -round(original["netAmount"] * rng.uniform(0.05, 1.0), 2)
+        else:
+            seller = sellers[bisect(seller_weights, rng.random() * seller_weights[-1])]
+            buyer_company = buyers[bisect(buyer_weights, rng.random() * buyer_weights[-1])]
+            buyer = {"name": buyer_company["name"], "identifier": {"type": "Nip", "value": buyer_company["nip"]}}
+            currency = CURRENCIES[bisect(currency_weights, rng.random() * currency_weights[-1])]
+            vat_rate = VAT_RATES[bisect(rate_weights, rng.random() * rate_weights[-1])]
+            net = round(min(rng.lognormvariate(NET_MU, NET_SIGMA), NET_MAX), 2)
         vat = round(net * vat_rate, 2)
-        gross = net + vat
+
+        prefix = "KOR" if original else "FV"
+        key = (seller["nip"], prefix, month)
+        numbers[key] = numbers.get(key, 0) + 1
 
         invoice = {
-            "ksefNumber": f"FAKE-{uuid.uuid4()}",
-            "invoiceNumber": f"FV/{random.randint(1, 100)}/{today.year}",
-            "issueDate": (today - timedelta(days=random.randint(0, 30))).date(),
-            "buyer": random.choice(BUYERS),
-            "seller": random.choice(SELLERS),
-            "netAmount": str(net),
-            "grossAmount": str(gross),
-            "vatAmount": str(vat),
-            "currency": "PLN",
+            "ksefNumber": f"{seller['nip']}-{ymd}-{rng.getrandbits(48):012X}-{rng.getrandbits(8):02X}",
+            "invoiceNumber": f"{prefix}/{numbers[key]}/{month}",
+            "issueDate": issue_date,
+            "invoicingDate": stored,
+            "acquisitionDate": stored,
+            "permanentStorageDate": stored,
+            "buyer": buyer,
+            "seller": seller,
+            "netAmount": net,
+            "grossAmount": round(net + vat, 2),
+            "vatAmount": vat,
+            "currency": currency,
             "invoiceType": invoice_type,
-            "formCode": {"systemCode": "FA (2)"},
+            "formCode": {"systemCode": "FA (2)", "schemaVersion": "1-0E", "value": "FA"},
         }
-        invoices.append(invoice)
-    
-    return invoices, None
+        if original:
+            invoice["correctedInvoice"] = {
+                "ksefNumber": original["ksefNumber"],
+                "invoiceNumber": original["invoiceNumber"],
+            }
+        elif invoice_type == "Vat":
+            originals.append(dict(invoice, _vat_rate=vat_rate))
+        yield invoice
+
+
+def iter_fake_batches(subject, count, batch_size=BATCH_SIZE, **kwargs):
+    """Yield invoices from iter_fake_invoices in lists of `batch_size`, e.g. for bulk inserts."""
+    invoices = iter_fake_invoices(subject, count, **kwargs)
+    while True:
+        batch = list(islice(invoices, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+def write_to_database(db, subject, count, table=None, batch_size=BATCH_SIZE, **kwargs):
+    """Generate invoices straight into Database `db` using bulk upserts. Returns number of inserted rows."""
+    table_args = {"table": table} if table else {}
+    inserted = 0
+    for batch in iter_fake_batches(subject, count, batch_size, **kwargs):
+        inserted += db.upsert_invoices(batch, subject, **table_args)
+    return inserted
+
+
+def write_json_files(directory, subject, count, per_file=BATCH_SIZE, **kwargs):
+    """Write invoices to JSON files shaped like a KSeF metadata response ({"invoices": [...]}). Returns file paths."""
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    for i, batch in enumerate(iter_fake_batches(subject, count, per_file, **kwargs)):
+        path = os.path.join(directory, f"{subject}_{i:05d}.json")
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({"invoices": batch}, f, ensure_ascii=False)
+        paths.append(path)
+    return paths
+
+
+def generate_fake_invoices(subject, num_invoices=50, seed=None):
+    """Generates a list of fake invoice dictionaries for a given subject."""
+    return list(iter_fake_invoices(subject, num_invoices, seed=seed, days=30)), None
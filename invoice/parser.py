@@ -0,0 +1,123 @@
+import xml.etree.ElementTree as ET
+
+PARSER_VERSION = 1 # podnieś, aby ponownie sparsować zapisane faktury
+
+# pola wiersza faktury (FaWiersz) -> kolumny invoice_lines
+LINE_FIELDS = {
+    "NrWierszaFa": "line_no",
+    "P_7": "name",
+    "P_8A": "unit",
+    "P_8B": "quantity",
+    "P_9A": "unit_net_price",
+    "P_11": "net_amount",
+    "P_11A": "gross_amount",
+    "P_12": "vat_rate",
+}
+
+# sufiks pól P_13_x / P_14_x (sumy w podziale na stawki) -> stawka VAT
+VAT_RATES = {
+    "1": "23",
+    "2": "8",
+    "3": "5",
+    "4": "4",
+    "5": "OSS",
+    "6_1": "0 KR",
+    "6_2": "0 WDT",
+    "6_3": "0 EX",
+    "7": "zw",
+    "8": "np I",
+    "9": "np II",
+    "10": "oo",
+    "11": "marża",
+}
+
+
+def _local(tag):
+    return tag.rsplit("}", 1)[-1]
+
+def _number(value):
+    try:
+        return float(value) if value not in (None, "") else None
+    except ValueError:
+        return None
+
+
+def parse_invoice(chunks):
+    """Parse FA(2)/FA(3) invoice XML given as iterable of byte chunks.
+
+    Uses an incremental pull parser and clears processed elements, so memory does not grow
+    with the number of lines. Returns dict with `lines`, `vat_totals` ({rate: [net, vat]})
+    and `due_dates`.
+    """
+    parser = ET.XMLPullParser(events=("start", "end"))
+    path = []
+    elems = []
+    lines = []
+    vat_totals = {}
+    due_dates = []
+    line = None
+
+    def handle(events):
+        nonlocal line
+        for event, elem in events:
+            name = _local(elem.tag)
+            if event == "start":
+                path.append(name)
+                elems.append(elem)
+                if name == "FaWiersz":
+                    line = {}
+                continue
+
+            path.pop()
+            elems.pop()
+            parent = path[-1] if path else None
+            text = (elem.text or "").strip()
+            if parent == "FaWiersz" and name in LINE_FIELDS and line is not None:
+                line[LINE_FIELDS[name]] = text
+            elif name == "FaWiersz":
+                lines.append(line)
+                line = None
+            elif parent == "Fa" and (name.startswith("P_13_") or name.startswith("P_14_")):
+                suffix = name[5:]
+                rate = VAT_RATES.get(suffix)
+                if rate:
+                    totals = vat_totals.setdefault(rate, [None, None])
+                    totals[0 if name.startswith("P_13_") else 1] = _number(text)
+            elif name == "Termin" and parent == "TerminPlatnosci":
+                if text: due_dates.append(text)
+            if len(path) <= 2 and elems:
+                # processed sections (Podmiot1, Fa children, FaWiersz, ...) are no longer needed
+                elems[-1].remove(elem)
+
+    for chunk in chunks:
+        parser.feed(chunk)
+        handle(parser.read_events())
+    parser.close()
+    handle(parser.read_events())
+
+    return {"lines": lines, "vat_totals": vat_totals, "due_dates": due_dates}
+
+
+def parse_pending(store, batch_size=500, progress=None, ksef_numbers=None):
+    """Parse stored invoices not parsed yet by this PARSER_VERSION and save results in bulk.
+
+    Each invoice is parsed once; failures are recorded too, so they are not retried on every run.
+    With `ksef_numbers` only those invoices are parsed (e.g. the ones just downloaded).
+    Returns number of parsed invoices.
+    """
+    parsed = 0
+    while True:
+        pending = store.unparsed(PARSER_VERSION, limit=batch_size, ksef_numbers=ksef_numbers)
+        if not pending:
+            return parsed
+        results = []
+        for ksef_number, content_hash in pending:
+            try:
+                result = parse_invoice(store.iter_chunks(ksef_number))
+                error = None
+            except ET.ParseError as e:
+                result, error = None, str(e)
+            results.append((ksef_number, content_hash, result, error))
+        store.save_parsed(results, PARSER_VERSION)
+        parsed += len(results)
+        if progress: progress(parsed)
@@ -0,0 +1,130 @@
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from invoice.download import iter_metadata_pages
+from db.batch import BatchWriteError
+from db.sqlite import OPTIMIZE_AFTER_ROWS, SET_WATERMARK_QUERY
+
+DEFAULT_MAX_WORKERS = 8   # globalny limit równoległych zapytań
+DEFAULT_PER_COMPANY = 3   # limit równoległych zapytań dla jednej firmy
+QUEUE_PAGES = 2           # ile stron może czekać na zapis na jeden wątek
+WATERMARK_OVERLAP = timedelta(hours=1) # zakładka przy pobieraniu przyrostowym
+
+
+def sync_metadata(BASE, sessions, subjects, db, from_date, to_date, max_workers=DEFAULT_MAX_WORKERS, per_company=DEFAULT_PER_COMPANY, fetch=None):
+    """Fetch metadata for every (company, subject) pair in parallel and insert it into `db`.
+
+    Fetching runs in a bounded thread pool (`max_workers` globally, `per_company` per company),
+    while the calling thread is the only one writing to the database. Pages are queued in a write
+    batch (see db.batch.WriteBatcher) as soon as they arrive and committed in larger transactions;
+    the queue is bounded so fetchers wait when the writer falls behind.
+
+    Pairs with a stored sync watermark fetch only invoices stored in KSeF since the watermark
+    (minus WATERMARK_OVERLAP); the rest fetch by issue date starting at `from_date`.
+    The watermark is moved to the start time of this sync when a pair finishes without errors,
+    in the same transaction as the pair's last invoices.
+
+    `fetch(company, auth_token, subject, from_date, date_type)` may replace the KSeF call
+    (e.g. mock data) and must return an iterable of (invoices, error) pages.
+    Returns (inserted, errors) where errors is a list of (company, subject, error).
+    """
+    if fetch is None:
+        def fetch(company, auth_token, subject, from_date, date_type):
+            return iter_metadata_pages(BASE, auth_token, subject=subject, from_date=from_date, to_date=to_date, date_type=date_type,
+                                       rate_key=sessions[company].get("nip"))
+
+    started = datetime.now(timezone.utc).isoformat(timespec="seconds")
+    pairs = [(company, sub) for company in sessions for sub in subjects]
+    ranges = {}
+    for company, sub in pairs:
+        watermark = db.get_sync_watermark(company, sub)
+        if watermark:
+            since = datetime.fromisoformat(watermark) - WATERMARK_OVERLAP
+            ranges[(company, sub)] = (since.isoformat(timespec="seconds"), "PermanentStorage")
+        else:
+            ranges[(company, sub)] = (from_date, "Issue")
+
+    max_workers = max(max_workers, 1)
+    company_limits = {name: threading.BoundedSemaphore(max(per_company, 1)) for name in sessions}
+    results = queue.Queue(maxsize=max_workers * QUEUE_PAGES)
+    stop = threading.Event()    # set when the writer gives up, fetchers stop at the next page
+
+    def worker(company, subject):
+        auth_token = sessions[company].get("accessToken")
+        error = None
+        try:
+            with company_limits[company]:
+                since, date_type = ranges[(company, subject)]
+                for invoices, error in fetch(company, auth_token, subject, since, date_type):
+                    if error or stop.is_set():
+                        break
+                    results.put((company, subject, invoices, None))
+        except Exception as e:
+            error = str(e)
+        # end of this pair
+        results.put((company, subject, None, error or False))
+
+    inserted = 0
+    errors = []
+    failed = set()
+    batch = db.batch()
+
+    def fail(pair, cause):
+        # keep the watermark so the next sync retries this range
+        if pair not in failed:
+            failed.add(pair)
+            errors.append((*pair, f"Błąd zapisu do bazy: {cause}"))
+
+    def write(add, pair=None):
+        nonlocal inserted
+        try:
+            inserted += add()
+        except BatchWriteError as e:
+            # whole transaction rolled back
+            for tag in e.tags:
+                fail(tag, e.cause)
+        except Exception as e:
+            if pair is None:
+                raise
+            fail(pair, e)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        for company, sub in pairs:
+            pool.submit(worker, company, sub)
+
+        # single writer: consume pages as soon as they arrive
+        pending = len(pairs)
+        try:
+            while pending:
+                company, sub, invoices, error = results.get()
+                if invoices is None:
+                    pending -= 1
+                    if error:
+                        errors.append((company, sub, error))
+                    elif (company, sub) not in failed:
+                        write(lambda: batch.add(SET_WATERMARK_QUERY, (company, sub, started), tag=(company, sub)), (company, sub))
+                    continue
+                print(f"Pobrano {len(invoices)} faktur z KSeF ({company}, {sub}).")
+                if (company, sub) not in failed:
+                    write(lambda: batch.insert_invoices(invoices, sub, table=company, tag=(company, sub)), (company, sub))
+            write(batch.flush)
+        finally:
+            # on error stop the fetchers and drain the queue, so none stays blocked on a full queue
+            # and the pool can shut down
+            stop.set()
+            while pending:
+                if results.get()[2] is None:
+                    pending -= 1
+
+    for _, row, error in batch.rejected:
+        ksef_number = row.get("ksefNumber") if isinstance(row, dict) else row[0]
+        print(f"Błąd przy wstawianiu faktury {ksef_number}: {error}")
+        # Also print the problematic invoice data for debugging
+        print(f"Dane faktury powodującej błąd: {row}")
+    stats = batch.stats()
+    print(f"Zapisano {stats['rows']} wierszy w {stats['transactions']} transakcjach, oczekiwanie na blokadę {stats['lock_wait']} s.")
+
+    if inserted >= OPTIMIZE_AFTER_ROWS:
+        db.optimize()
+    return inserted, errors
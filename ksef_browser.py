@@ -1,6 +1,7 @@
 from authentication.token import start_session
 from invoice.download import download_metadata, download_invoice
 from db.sqlite import Database
+from db.batch import BatchWriteError
 from datetime import datetime, timezone, timedelta
 import requests
 import os
@@ -237,7 +238,7 @@ if not st.session_state["invoices_df"].empty:
         st.session_state["invoices_df"],
         key="invoice_editor",
         on_change=process_edits,
-        column_config={"KSeF": None, "Podmiot": None, "Opłacona": st.column_config.CheckboxColumn(required=True)},
+        column_config={"KSeF": None, "Podmiot": None, "doc_hash": None, "Opłacona": st.column_config.CheckboxColumn(required=True)},
         disabled=st.session_state["invoices_df"].columns.drop("Opłacona"),
         height=600
     )
@@ -276,7 +277,7 @@ def run_update():
         if USE_MOCK_DATA:
             invoices, error = generate_fake_invoices(subject=sub)
         else:
-            invoices, error = download_metadata(BASE, auth_token, subject=sub, from_date=begin_date, to_date=end_date)
+            invoices, error = download_metadata(BASE, auth_token, subject=sub, from_date=begin_date, to_date=end_date, rate_key=session.get("nip"))
         
         if error:
             st.warning(f"Błąd podczas pobierania faktur z KSeF dla podmiotu {sub}: {error}")
@@ -286,9 +287,12 @@ def run_update():
             ksef_number = invoice.get('ksefNumber')
             # Check if invoice already exists before inserting
             if not db.invoice_exists(ksef_number, sub):
+                # rows are only queued; inserted ones are counted when a batch is committed
                 try:
-                    db.insert_invoice(invoice, sub)
-                    inserted += 1
+                    inserted += db.insert_invoice(invoice, sub)
+                except BatchWriteError as e:
+                    # automatic commit of the batch failed, not this invoice
+                    print(f"Błąd przy komitowaniu faktur podmiotu {sub}: {e}")
                 except Exception as e:
                     print(f"Błąd przy wstawianiu faktury {ksef_number}: {e}")
                     # Also print the problematic invoice data for debugging
@@ -296,9 +300,12 @@ def run_update():
                     continue
         # commit after each subject to reduce lock contention
         try:
-            db.commit()
+            inserted += db.commit()
         except Exception as e:
             print(f"Błąd przy komitowaniu po podmiocie {sub}: {e}")
+        for _, row, error in db.batcher.rejected:
+            print(f"Błąd przy wstawianiu faktury {row[0]}: {error}")
+        db.batcher.rejected.clear()
 
         # update seller list
         st.session_state[sellers_key][sub] = db.get_unique_sellers(sub)
@@ -1,12 +1,20 @@
 from authentication.token import start_session, start_multi_session
-from invoice.download import download_metadata, download_invoice
+from authentication.renewer import TokenRenewer
 from db.sqlite import Database
+from db.documents import DocumentStore
+from api.client import get_client
 from datetime import datetime, timedelta
 import os
 import json
-import pandas as pd
 import streamlit as st
 from invoice.mock import generate_fake_invoices
+from invoice.sync import sync_metadata
+from invoice.bulk import download_many
+from invoice.bundle import build_zip
+from invoice.cache import InvoiceCache
+from invoice.parser import parse_pending
+from invoice.dataframe import get_invoices_df, format_invoice_type_display
+from monitoring.metrics import REGISTRY, serve_metrics
 
 DATA_FOLDER = "data"
 
@@ -24,6 +32,26 @@ SUBJECT_DISPLAY_NAMES = {
 # For Debugging
 USE_MOCK_DATA = True
 RESET_DB_ON_START = False
+# mock invoices and their sync watermarks must not end up in the real database
+DB_FILE = "ksef_mock.db" if USE_MOCK_DATA else "ksef.db"
+
+# Concurrency of KSeF sync (all requests / requests per company)
+SYNC_MAX_WORKERS = 8
+SYNC_PER_COMPANY = 3
+
+# Parallel invoice XML downloads
+DOWNLOAD_WORKERS = 6
+
+# In-memory cache of invoice XML (MB); documents are also kept in the database
+INVOICE_CACHE_MB = 64
+
+# Renew KSeF tokens in background this many minutes before they expire
+TOKEN_RENEW_MARGIN_MIN = 5
+
+# HTTP/DB metrics: files written after each update, optional /metrics endpoint (None = off)
+METRICS_PROM_FILE = "metrics.prom"
+METRICS_JSON_FILE = "metrics.json"
+METRICS_PORT = None
 
 # Default Streamlit page configuration for wide layout - must be in a function
 def wide_space_default():
@@ -58,7 +86,7 @@ tokenPath = data_path("secret.json")
 sessionPath = data_path("session.json")
 downloadPath = data_path("downloads")
 
-# last ksef extraction date
+# fallback start date for companies/subjects without a sync watermark in the database
 try:
     with open(sessionPath, 'r') as f:
         session_data = json.load(f)
@@ -79,6 +107,21 @@ except (FileNotFoundError, json.JSONDecodeError):
 
 end_date = (datetime.now() + timedelta(days=1)).isoformat()
 
+# one background token renewer per server process
+@st.cache_resource
+def start_token_renewer():
+    return TokenRenewer(BASE, tokenPath, sessionPath, margin=timedelta(minutes=TOKEN_RENEW_MARGIN_MIN)).start()
+
+if not USE_MOCK_DATA:
+    start_token_renewer()
+
+@st.cache_resource
+def start_metrics_server():
+    return serve_metrics(METRICS_PORT)
+
+if METRICS_PORT:
+    start_metrics_server()
+
 # Load company names from secret file for sidebar filter
 if "company_names" not in st.session_state:
     with open(tokenPath, 'r') as f:
@@ -88,9 +131,17 @@ if "company_names" not in st.session_state:
 # initialize database (only once per Streamlit session)
 if "db" not in st.session_state:
     # Do not drop tables on normal load
-    st.session_state["db"] = Database(data_path("ksef.db"), drop_tables=RESET_DB_ON_START, table_names=st.session_state.company_names)
+    st.session_state["db"] = Database(data_path(DB_FILE), drop_tables=RESET_DB_ON_START, table_names=st.session_state.company_names)
 db = st.session_state["db"]
 
+# compressed invoice XML documents, stored in the same database file
+if "document_store" not in st.session_state:
+    st.session_state["document_store"] = DocumentStore(data_path(DB_FILE))
+store = st.session_state["document_store"]
+if "invoice_cache" not in st.session_state:
+    st.session_state["invoice_cache"] = InvoiceCache(BASE, store, max_bytes=INVOICE_CACHE_MB * 1024 * 1024)
+invoice_cache = st.session_state["invoice_cache"]
+
 # ================
 #region Streamlit sidebar
 # UI and filtering logic
@@ -175,81 +226,26 @@ show_only_paid = (paid_status_selected == "Tylko opłacone")
 st.sidebar.markdown("**Typ faktury**")
 invoice_type_options = ["Wszystkie", "Vat", "Zal", "Kor", "Roz", "Upr"]
 
-# Display names for invoice types
-INVOICE_TYPE_DISPLAY = {
-    "Vat": "Vat",
-    "Kor": "Korygująca",
-    "Roz": "Rozliczeniowa",
-    "Zal": "Zaliczkowa",
-    "Upr": "Upr",
-    "Wszystkie": "Wszystkie"
-}
-
-def format_invoice_type_display(val):
-    return INVOICE_TYPE_DISPLAY.get(val, val)
-
 invoice_type_selected = st.sidebar.selectbox("Wybierz typ", invoice_type_options, index=0, key="invoice_type_select", label_visibility="collapsed",
                                              on_change=set_rerun_flag, format_func=format_invoice_type_display)
 invoice_type_filter = None if invoice_type_selected == "Wszystkie" else invoice_type_selected
 
 
-def get_invoices_df(db, subject, date_from=None, date_to=None, price_min=None, price_max=None, only_paid=False, only_unpaid=False, seller_name=None, invoice_type=None, table=None):
-    """Fetch invoices from DB, format fields for display and return a DataFrame.
+def patch_paid_status(updates):
+    """Set paid status in the cached invoices DataFrame instead of querying the database again.
 
-    - `header_map` is an optional dict mapping raw column names to desired display names.
+    `updates` maps row labels of the current DataFrame to the new status; all of them are
+    applied before rows are dropped, so the labels stay valid.
     """
-    rows = db.query_raw_with_filters(
-        subject,
-        date_from=date_from,
-        date_to=date_to,
-        price_min=price_min,
-        price_max=price_max,
-        only_paid=only_paid,
-        seller_name=seller_name,
-        invoice_type=invoice_type,
-        table=table
-    )
-    # If only_unpaid is True, filter the results client-side
-    if only_unpaid and rows:
-        rows = [row for row in rows if not row.get('is_paid', False)]
-    
-    df = pd.DataFrame(rows)
-    if df.empty:
-        return df
-
-    # Normalize/format fields similar to previous DB formatting
-    if 'is_paid' in df.columns:
-        df['is_paid'] = df['is_paid'].astype(bool)
-
-    for amount_field in ['net_amount', 'gross_amount', 'vat_amount']:
-        if amount_field in df.columns:
-            # keep numeric for filtering, but create a formatted string column for display
-            df[amount_field] = pd.to_numeric(df[amount_field], errors='coerce')
-            df[amount_field] = df[amount_field].apply(lambda v: (f"{v:,.2f}".replace(',', ' ').replace('.', ',')) if pd.notna(v) else v)
-
-    # Format invoice type display
-    if 'type' in df.columns:
-        df['type'] = df['type'].apply(lambda v: INVOICE_TYPE_DISPLAY.get(v, v) if pd.notna(v) else v)
-
-    # Apply header rename if provided
-    header_map = {
-        "ksef": "KSeF",
-        "subject": "Podmiot",
-        "invoice_number": "Numer Faktury",
-        "invoice_date": "Data Wystawienia",
-        "buyer_name": "Nabywca",
-        "buyer_id": "NIP Nabywcy",
-        "seller_name": "Sprzedawca",
-        "seller_nip": "NIP Sprzedawcy",
-        "net_amount": "Kwota Netto",
-        "gross_amount": "Kwota Brutto",
-        "vat_amount": "Kwota VAT",
-        "is_paid": "Opłacona",
-        "type": "Typ",
-        "currency": "Waluta",
-    }
-    df = df.rename(columns=header_map)
-    return df
+    df = st.session_state["invoices_df"]
+    for label, paid in updates.items():
+        df.loc[label, "Opłacona"] = paid
+    # rows no longer matching the paid status filter disappear, as they would after a new query
+    if paid_status_selected in ("Tylko opłacone", "Tylko nie opłacone"):
+        keep_paid = paid_status_selected == "Tylko opłacone"
+        dropped = [label for label, paid in updates.items() if paid != keep_paid]
+        if dropped:
+            st.session_state["invoices_df"] = df.drop(index=dropped).reset_index(drop=True)
 
 
 def process_edits():
@@ -261,24 +257,27 @@ def process_edits():
     if not changes.get('edited_rows'):
         return
 
+    # group edited rows by new status, so each status is one database transaction
+    edits = {}
     for row_index, changed_columns in changes['edited_rows'].items():
         if "Opłacona" in changed_columns:
-            new_status = changed_columns["Opłacona"]
-            
-            # Get the original row from the dataframe to find the ksef number and invoice number
-            original_row = original_df.iloc[row_index] 
-            
-            ksef_id = original_row["KSeF"]
-            subject_val = original_row["Podmiot"]
-            invoice_number = original_row["Numer Faktury"]
+            edits.setdefault(bool(changed_columns["Opłacona"]), []).append(original_df.index[row_index])
 
-            if db.update_paid_status(ksef_id, subject_val, new_status, table=company):
-                st.toast(f"Zaktualizowano status faktury {invoice_number}")
-                # Update the main dataframe in the session state to reflect the successful change
-                # Use .loc with the actual index label to be safe
-                st.session_state["invoices_df"].loc[original_df.index[row_index], "Opłacona"] = new_status
-            else:
-                st.toast(f"Błąd podczas aktualizacji faktury {invoice_number}")
+    updated = {}
+    for new_status, labels in edits.items():
+        rows = original_df.loc[labels]
+        try:
+            db.set_paid_bulk(zip(rows["KSeF"], rows["Podmiot"]), new_status, table=company)
+        except Exception as e:
+            st.toast(f"Błąd podczas aktualizacji {len(labels)} faktur: {e}")
+            continue
+        updated.update(dict.fromkeys(labels, new_status))
+        if len(labels) == 1:
+            st.toast(f"Zaktualizowano status faktury {rows['Numer Faktury'].iloc[0]}")
+        else:
+            st.toast(f"Zaktualizowano status {len(labels)} faktur")
+    # patch once, after every group, while labels of original_df are still valid
+    patch_paid_status(updated)
 
 
 # Corrected Data Loading and Display Logic
@@ -304,7 +303,12 @@ if not st.session_state["invoices_df"].empty:
             "Podmiot": None,
             "Nabywca": None,
             "NIP Sprzedawcy": None,
+            "Hash XML": None,
             "Opłacona": st.column_config.CheckboxColumn(required=True),
+            # typed columns from get_invoices_df, formatted here for display
+            "Data Wystawienia": st.column_config.DateColumn(format="YYYY-MM-DD"),
+            "Kwota Netto": st.column_config.NumberColumn(format="localized"),
+            "Kwota Brutto": st.column_config.NumberColumn(format="localized"),
         },
         height=600,
         hide_index=True,
@@ -333,30 +337,52 @@ def _download_selected(company_name):
     if not selected_indices:
         return
 
-    rows_to_download = selected_indices
+    rows = df.iloc[selected_indices]
+    ksef_ids = list(rows["KSeF"])
+    # invoices with doc_hash are already in the document store - no session or download needed
+    missing = [k for k, h in zip(ksef_ids, rows["Hash XML"]) if not h]
+    downloaded, skipped, failed = 0, len(ksef_ids) - len(missing), []
 
-    try:
-        session = start_session(BASE, tokenPath, sessionPath, company_name)
-    except Exception as e:
-        st.error("Nie udało się otworzyć sesji KSEF")
-        st.error(str(e))
-        return
-
-    auth_token = session.get("accessToken")
-    if not auth_token:
-        st.error(f"Brak tokenu dla {company_name}; nie można pobrać faktur.")
-        return
-
-    downloaded = 0
-    for ridx in rows_to_download:
-        row = df.iloc[ridx]
+    if missing:
+        try:
+            session = start_session(BASE, tokenPath, sessionPath, company_name)
+        except Exception as e:
+            st.error("Nie udało się otworzyć sesji KSEF")
+            st.error(str(e))
+            return
 
-        ksef_id = row.get("KSeF")
-        os.makedirs(downloadPath, exist_ok=True)
-        download_invoice(BASE, auth_token, ksef_id, path=downloadPath)
-        downloaded += 1
+        auth_token = session.get("accessToken")
+        if not auth_token:
+            st.error(f"Brak tokenu dla {company_name}; nie można pobrać faktur.")
+            return
 
-    st.success(f"Pobrano {downloaded} faktur.")
+        bar = st.progress(0.0, text="Pobieranie faktur...")
+        def show_progress(done, total):
+            bar.progress(done / total if total else 1.0, text=f"Pobieranie faktur... {done}/{total}")
+
+        downloaded, already_stored, failed = download_many(
+            BASE, auth_token, missing, downloadPath, max_workers=DOWNLOAD_WORKERS, progress=show_progress,
+            manifest_file=os.path.join(downloadPath, f"manifest_{company_name}.json"), store=store,
+            rate_key=session.get("nip"))
+        skipped += already_stored
+        bar.empty()
+        # mark locally stored invoices in the company table and in the cached list, so the next click skips them
+        hashes = store.get_hashes(missing)
+        db.set_document_hashes(hashes, table=company_name)
+        df.loc[rows.index, "Hash XML"] = [hashes.get(k, h) for k, h in zip(ksef_ids, rows["Hash XML"])]
+        print("KSeF HTTP:", get_client(BASE).stats())
+    # extract line items, VAT totals and due dates from the selected documents
+    parse_pending(store, ksef_numbers=ksef_ids)
+
+    st.success(f"Pobrano {downloaded} faktur, pominięto {skipped} już pobranych.")
+    if failed:
+        st.error(f"Nie udało się pobrać {len(failed)} faktur - zostaną pobrane przy następnej próbie.")
+
+    # one archive with all selected invoices, built on disk
+    zip_path, _ = build_zip(ksef_ids, downloadPath, os.path.join(downloadPath, "zip", f"faktury_{company_name}.zip"), store=store)
+    with open(zip_path, "rb") as f:
+        st.download_button("Zapisz faktury (ZIP)", data=f, file_name=os.path.basename(zip_path),
+                           mime="application/zip", on_click="ignore", use_container_width=True)
 
 def set_selected_paid(company_name, paid=True):
     df = st.session_state.get("invoices_df")
@@ -374,44 +400,41 @@ def set_selected_paid(company_name, paid=True):
     else:
         rows_to_update = selected_indices
 
-    updated = 0
+    keys = []
+    labels = []
     for ridx in rows_to_update:
         try:
-            row = df.iloc[ridx]
+            label = df.index[ridx]
         except Exception:
-            try:
-                row = df.loc[ridx]
-            except Exception:
+            if ridx not in df.index:
                 st.error(f"Nie można odczytać wiersza: {ridx}")
                 continue
+            label = ridx
+        row = df.loc[label]
 
         ksef_id = row.get("KSeF") or row.get("ksef")
         subject_val = row.get("Podmiot") or row.get("subject")
-        invoice_number = row.get("Numer Faktury") or row.get("invoice_number")
         if not ksef_id or not subject_val:
             st.error(f"Nieprawidłowe dane w wierszu {ridx}; pomijam.")
             continue
+        keys.append((ksef_id, subject_val))
+        labels.append(label)
 
-        if db.update_paid_status(ksef_id, subject_val, paid, table=company_name):
-            # Update the session DataFrame view
-            try:
-                st.session_state["invoices_df"].loc[df.index[ridx], "Opłacona"] = paid
-            except Exception:
-                # fallback if index alignment differs
-                try:
-                    st.session_state["invoices_df"].iloc[ridx, st.session_state["invoices_df"].columns.get_loc("Opłacona")] = paid
-                except Exception:
-                    pass
-            updated += 1
-        else:
-            st.error(f"Błąd podczas aktualizacji faktury {invoice_number}")
-
-    if updated:
-        st.success(f"Zaktualizowano status dla {updated} faktur.")
-        st.session_state["rerun_needed"] = True
-        st.rerun()
-    else:
+    if not keys:
         st.info("Nie zaktualizowano żadnej faktury.")
+        return
+
+    # one transaction for all selected invoices
+    try:
+        db.set_paid_bulk(keys, paid, table=company_name)
+    except Exception as e:
+        st.error(f"Błąd podczas aktualizacji {len(keys)} faktur: {e}")
+        return
+
+    patch_paid_status(dict.fromkeys(labels, paid))
+    st.success(f"Zaktualizowano status dla {len(keys)} faktur.")
+    # redraw the table from the patched DataFrame, without a new query
+    st.rerun()
 
 
 col1, col2 = st.columns(2)
@@ -423,6 +446,40 @@ with col2:
     if st.button("Ustaw opłacone", use_container_width=True):
         set_selected_paid(company, paid=True)
 
+def show_selected_xml(company_name):
+    """Show XML of the single selected invoice; served from local cache when already downloaded."""
+    df = st.session_state.get("invoices_df")
+    selected_indices = get_selected_row_indices()
+    if df is None or df.empty or len(selected_indices) != 1:
+        st.info("Zaznacz jedną fakturę.")
+        return
+    row = df.iloc[selected_indices[0]]
+    ksef_id = row.get("KSeF")
+
+    # doc_hash marks invoices already in the document store, others may still be there (e.g. from a backfill)
+    stored = bool(row.get("Hash XML")) or store.has(ksef_id)
+    session = {}
+    if not stored:
+        try:
+            session = start_session(BASE, tokenPath, sessionPath, company_name)
+        except Exception as e:
+            st.error(f"Nie udało się otworzyć sesji KSEF: {e}")
+            return
+    content = invoice_cache.get(session.get("accessToken"), ksef_id, rate_key=session.get("nip"))
+    if content is None:
+        st.error(f"Nie udało się pobrać faktury {ksef_id}.")
+        return
+    if not row.get("Hash XML"):
+        hashes = store.get_hashes([ksef_id])
+        db.set_document_hashes(hashes, table=company_name)
+        df.loc[row.name, "Hash XML"] = hashes.get(ksef_id)
+    st.code(content.decode("utf-8", errors="replace"), language="xml")
+    print("Invoice cache:", invoice_cache.stats())
+
+with st.expander("Podgląd XML zaznaczonej faktury"):
+    if st.button("Pokaż XML", use_container_width=True):
+        show_selected_xml(company)
+
 # Status container - always visible
 status_container = st.empty()
 
@@ -445,48 +502,33 @@ if "updated_once" not in st.session_state:
     st.session_state["updated_once"] = False
 
 def run_update():
-    sessions = start_multi_session(BASE, tokenPath, sessionPath)
-    inserted = 0
-    for comp_name in sessions:
-        auth_token = sessions[comp_name].get("accessToken")
-        if not auth_token and not USE_MOCK_DATA:
+    sessions, auth_report = start_multi_session(BASE, tokenPath, sessionPath, return_report=True)
+    ready = {}
+    for comp_name, result in auth_report.items():
+        if not result["ok"]:
+            st.warning(f"Nie udało się uwierzytelnić {comp_name} ({result['seconds']}s): {result['error']}")
+        auth_token = sessions.get(comp_name, {}).get("accessToken")
+        if (not result["ok"] or not auth_token) and not USE_MOCK_DATA:
             st.error(f"Brak tokenu autoryzacji dla {comp_name}; nie można aktualizować z KSeF.")
             continue
-        
-        for sub in SUBJECTS:
-            if USE_MOCK_DATA:
-                invoices, error = generate_fake_invoices(subject=sub)
-            else:
-                invoices, error = download_metadata(BASE, auth_token, subject=sub, from_date=begin_date, to_date=end_date)
-            
-            if error:
-                st.warning(f"Błąd podczas pobierania faktur z KSeF dla {comp_name} podmiotu {sub}: {error}")
-                continue
-            print(f"Pobrano {len(invoices)} faktur z KSeF.")
-            for invoice in invoices:
-                ksef_number = invoice.get('ksefNumber')
-                # Check if invoice already exists before inserting
-                if not db.invoice_exists(ksef_number, sub, table=comp_name):
-                    try:
-                        db.insert_invoice(invoice, sub, table=comp_name)
-                        inserted += 1
-                    except Exception as e:
-                        print(f"Błąd przy wstawianiu faktury {ksef_number}: {e}")
-                        # Also print the problematic invoice data for debugging
-                        print(f"Dane faktury powodującej błąd: {invoice}")
-                        continue
-            # commit after each subject to reduce lock contention
-            try:
-                db.commit()
-            except Exception as e:
-                print(f"Błąd przy komitowaniu po podmiocie {sub}: {e}")
-    
-    # update seller list
-    st.session_state[sellers_key][company][subject] = db.get_unique_sellers(sub, table=company)
-    # if we updated sellers for the currently selected subject, recreate the selectbox widget
+        ready[comp_name] = sessions.get(comp_name, {})
 
+    fetch = None
+    if USE_MOCK_DATA:
+        fetch = lambda comp_name, auth_token, sub, *_: [generate_fake_invoices(subject=sub)]
+
+    inserted, errors = sync_metadata(BASE, ready, SUBJECTS, db, begin_date, end_date,
+                                     max_workers=SYNC_MAX_WORKERS, per_company=SYNC_PER_COMPANY, fetch=fetch)
+    for comp_name, sub, error in errors:
+        st.warning(f"Błąd podczas pobierania faktur z KSeF dla {comp_name} podmiotu {sub}: {error}")
+
+    # update seller list - reloaded from db on next rerun
+    st.session_state[sellers_key] = {}
 
     print(f"Wstawiono {inserted} nowych faktur do bazy.")
+    print("KSeF HTTP:", get_client(BASE).stats())
+    REGISTRY.write_prometheus(data_path(METRICS_PROM_FILE))
+    REGISTRY.write_json(data_path(METRICS_JSON_FILE))
     return inserted
 
 should_run = (not st.session_state["updated_once"])
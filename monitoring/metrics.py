@@ -0,0 +1,330 @@
+import functools
+import inspect
+import json
+import os
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# Granice kubełków histogramów (Prometheus "le")
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+BYTES_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+ROWS_BUCKETS = (0, 1, 10, 100, 1000, 10000, 100000, 1000000)
+
+
+class Histogram:
+    """Cumulative-bucket histogram in the Prometheus sense, not thread-safe on its own."""
+
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1) # last one is +Inf
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        else:
+            self.counts[-1] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative(self):
+        total = 0
+        result = []
+        for count in self.counts:
+            total += count
+            result.append(total)
+        return result
+
+    def quantile(self, q):
+        """Estimate quantile by linear interpolation inside the bucket, like histogram_quantile()."""
+        if not self.count:
+            return None
+        rank = q * self.count
+        lower = 0.0
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            if count and seen + count >= rank:
+                return lower + (bound - lower) * (rank - seen) / count
+            seen += count
+            lower = bound
+        return self.buckets[-1] if self.buckets else None
+
+
+class MetricsRegistry:
+    """Histograms and counters keyed by metric name and label values."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = {}    # name -> {labels tuple: Histogram}
+        self.counters = {}      # name -> {labels tuple: float}
+        self.buckets = {}       # name -> bucket bounds
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            series = self.histograms.setdefault(name, {})
+            histogram = series.get(key)
+            if histogram is None:
+                histogram = series[key] = Histogram(self.buckets.setdefault(name, buckets))
+            histogram.observe(value)
+
+    def inc(self, name, value=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            series = self.counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+    def reset(self):
+        with self.lock:
+            self.histograms.clear()
+            self.counters.clear()
+
+    def snapshot(self) -> dict:
+        """JSON-serializable state with count, sum, mean and estimated p50/p95/p99 per series."""
+        with self.lock:
+            histograms = {}
+            for name, series in sorted(self.histograms.items()):
+                histograms[name] = [{
+                    "labels": dict(key),
+                    "count": h.count,
+                    "sum": round(h.sum, 6),
+                    "mean": round(h.sum / h.count, 6) if h.count else None,
+                    "p50": _round(h.quantile(0.5)),
+                    "p95": _round(h.quantile(0.95)),
+                    "p99": _round(h.quantile(0.99)),
+                    "buckets": dict(zip([str(b) for b in h.buckets] + ["+Inf"], h.cumulative())),
+                } for key, h in sorted(series.items())]
+            counters = {
+                name: [{"labels": dict(key), "value": value} for key, value in sorted(series.items())]
+                for name, series in sorted(self.counters.items())
+            }
+        return {"timestamp": time.time(), "histograms": histograms, "counters": counters}
+
+    def prometheus(self) -> str:
+        """Prometheus text exposition format (version 0.0.4)."""
+        lines = []
+        with self.lock:
+            for name, series in sorted(self.counters.items()):
+                lines.append(f"# TYPE {name} counter")
+                for key, value in sorted(series.items()):
+                    lines.append(f"{name}{_labels(key)} {value}")
+            for name, series in sorted(self.histograms.items()):
+                lines.append(f"# TYPE {name} histogram")
+                for key, h in sorted(series.items()):
+                    bounds = [_format_bound(b) for b in h.buckets] + ["+Inf"]
+                    for bound, count in zip(bounds, h.cumulative()):
+                        lines.append(f"{name}_bucket{_labels(key + (('le', bound),))} {count}")
+                    lines.append(f"{name}_sum{_labels(key)} {h.sum}")
+                    lines.append(f"{name}_count{_labels(key)} {h.count}")
+        return "\n".join(lines) + "\n"
+
+    def write_json(self, path):
+        _write_atomic(path, json.dumps(self.snapshot(), indent=2, ensure_ascii=False))
+
+    def write_prometheus(self, path):
+        """Write text file, e.g. for node_exporter textfile collector."""
+        _write_atomic(path, self.prometheus())
+
+
+def _round(value):
+    return round(value, 6) if value is not None else None
+
+def _format_bound(bound):
+    return repr(float(bound)) if isinstance(bound, float) else str(bound)
+
+def _labels(key):
+    if not key:
+        return ""
+    escaped = []
+    for name, value in key:
+        value = str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+        escaped.append(f'{name}="{value}"')
+    return "{" + ",".join(escaped) + "}"
+
+def _write_atomic(path, text):
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+
+REGISTRY = MetricsRegistry()
+
+
+# --- operacje z pomiarem czasu i oczekiwania na blokadę ---
+
+_local = threading.local()
+
+def _frames():
+    frames = getattr(_local, "frames", None)
+    if frames is None:
+        frames = _local.frames = []
+    return frames
+
+
+def add_lock_wait(seconds):
+    """Count `seconds` of waiting (for a lock, pooled connection, ...) to the running timed operation."""
+    frames = _frames()
+    if frames:
+        frames[-1][0] += seconds
+
+
+class TimedLock:
+    """threading.Lock that adds time spent waiting for it to the running timed operation of this thread."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+
+    def acquire(self, blocking=True, timeout=-1):
+        start = time.perf_counter()
+        acquired = self._lock.acquire(blocking, timeout)
+        add_lock_wait(time.perf_counter() - start)
+        return acquired
+
+    def release(self):
+        self._lock.release()
+
+    def locked(self):
+        return self._lock.locked()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+def _row_count(result):
+    if isinstance(result, bool) or result is None:
+        return None
+    if isinstance(result, int):
+        return result
+    if isinstance(result, dict) and result and all(isinstance(v, list) for v in result.values()):
+        return len(next(iter(result.values()))) # columnar result: column name -> values
+    if isinstance(result, (list, dict, set)):
+        return len(result)
+    return None
+
+def timed(component, operation, func):
+    """Wrap `func` to record `<component>_operation_duration_seconds`, lock wait, rows and errors."""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        frames = _frames()
+        frame = [0.0]
+        frames.append(frame)
+        start = time.perf_counter()
+        result = None
+        failed = True
+        try:
+            result = func(*args, **kwargs)
+            failed = False
+            return result
+        finally:
+            duration = time.perf_counter() - start
+            frames.pop()
+            if frames:
+                frames[-1][0] += frame[0] # nested operation: its lock wait counts for the caller too
+            _record(component, operation, duration, frame[0], None if failed else _row_count(result), failed)
+    return wrapper
+
+def timed_generator(component, operation, func):
+    """Like `timed` for generator functions: time spent producing the items, summed over the whole iteration.
+
+    Time the consumer spends between items is not counted. Recorded when the generator is
+    exhausted, closed or fails.
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        gen = func(*args, **kwargs)
+        duration = 0.0
+        lock_wait = 0.0
+        failed = True
+        try:
+            while True:
+                # a frame per step only, the consumer may run other timed operations between items
+                frames = _frames()
+                frame = [0.0]
+                frames.append(frame)
+                start = time.perf_counter()
+                try:
+                    item = next(gen)
+                except StopIteration:
+                    failed = False
+                    return
+                finally:
+                    duration += time.perf_counter() - start
+                    frames.pop()
+                    if frames:
+                        frames[-1][0] += frame[0]
+                    lock_wait += frame[0]
+                try:
+                    yield item
+                except GeneratorExit:
+                    failed = False # consumer stopped early
+                    raise
+        finally:
+            gen.close()
+            _record(component, operation, duration, lock_wait, None, failed)
+    return wrapper
+
+def _record(component, operation, duration, lock_wait, rows, failed):
+    REGISTRY.observe(f"{component}_operation_duration_seconds", duration, operation=operation)
+    REGISTRY.observe(f"{component}_lock_wait_seconds", lock_wait, operation=operation)
+    if failed:
+        REGISTRY.inc(f"{component}_operation_errors_total", operation=operation)
+    elif rows is not None:
+        REGISTRY.observe(f"{component}_operation_rows", rows, buckets=ROWS_BUCKETS, operation=operation)
+
+def instrumented(component):
+    """Class decorator: time every public method of the class with `timed` (`timed_generator` for generators)."""
+    def decorate(cls):
+        for name, attr in list(vars(cls).items()):
+            if callable(attr) and not name.startswith("_"):
+                wrap = timed_generator if inspect.isgeneratorfunction(attr) else timed
+                setattr(cls, name, wrap(component, name, attr))
+        return cls
+    return decorate
+
+
+# --- udostępnianie ---
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    registry = REGISTRY
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.startswith("/metrics.json"):
+            body = json.dumps(self.registry.snapshot(), ensure_ascii=False).encode("utf-8")
+            content_type = "application/json"
+        elif self.path.startswith("/metrics"):
+            body = self.registry.prometheus().encode("utf-8")
+            content_type = "text/plain; version=0.0.4; charset=utf-8"
+        else:
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def serve_metrics(port, host="127.0.0.1", registry=REGISTRY):
+    """Serve /metrics (Prometheus) and /metrics.json in a background thread. Returns the server."""
+    handler = type("MetricsHandler", (_MetricsHandler,), {"registry": registry})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    return server